@@ -5,6 +5,7 @@ import glob
 from tqdm import tqdm
 
 import torch
+import torch.nn.functional as F
 import pandas as pd
 import numpy as np
 from torch.utils.data import DataLoader
@@ -12,81 +13,184 @@ from torch.utils.data import DataLoader
 
 from yolov3 import evaluate
 from yolov3 import models
+from yolov3 import shared
 from yolov3 import utils as yoloutils
-from retrain import utils
+from retrain import utils, checkpoints, gating
 from retrain.dataloader import LabeledSet
+import analysis.results as rload
+import analysis.detections as dcache
+import analysis.cascade as casc
+
+# Options of inference gating and cascade inference, which change benchmark results
+SKIP_OPTIONS = (
+    "gate_threshold",
+    "cascade_img_size",
+    "cascade_model_config",
+    "cascade_weights",
+    "cascade_min_conf",
+    "cascade_max_conf",
+    "cascade_audit",
+)
 
 
 def get_checkpoint(folder, prefix, epoch):
     """Retrieve the checkpoint file corresponding to the given prefix and epoch."""
-    ckpts = glob.glob(f"{folder}/{prefix}*_ckpt_{epoch}.pth")
+    ckpt = checkpoints.get_registry(folder).find(prefix, epoch)
 
-    if len(ckpts) == 0:
+    if ckpt is None:
         return f"{folder}/init_ckpt_{epoch}.pth"
 
-    return ckpts[0]
+    return ckpt
+
+
+def get_checkpoint_epochs(start, end, total_epochs, roll=False):
+    """Get the epochs of the checkpoints averaged together for a benchmark."""
+    if roll:
+        return list(range(max(1, end - total_epochs + 1), end + 1))
+    return list(
+        sorted(set(np.linspace(start, end, total_epochs, dtype=np.dtype(np.int16))))
+    )
 
 
 def benchmark(img_folder, prefix, epoch, config):
     return benchmark_avg(img_folder, prefix, epoch, epoch, 1, config)
 
 
-def get_img_detections(checkpoints, prefix, config, loader, silent):
-    detections_by_img = dict()
-    model_def = yoloutils.parse_model_config(config["model_config"])
-    model = models.get_eval_model(model_def, config["img_size"])
-    yoloutils.clear_vram()
+def get_img_detections(checkpoints, prefix, config, loader, silent, device=None):
+    store = dcache.get_store(config)
+    paths = list(dict.fromkeys(loader.dataset.imgs))
+    detections_by_img = {path: None for path in paths}
+    model = None
+
+    # Frames similar to the last inferred frame reuse its detections, so only the
+    # inferred frames are looked up and cached
+    plan = {path: path for path in paths}
+    threshold = gating.get_gate_threshold(config)
+    if threshold is not None:
+        plan = gating.plan_inference(paths, threshold)
+        skipped = len(paths) - len(gating.get_inferred(plan))
+        print(f"Gating skipped inference on {skipped} of {len(paths)} frames")
+    inferred = [path for path in paths if plan[path] == path]
+
+    # Frames the screening model is confident about are settled with its detections,
+    # except for audited frames
+    settled, audited = dict(), set()
+    cascade = casc.get_cascade(config)
+    if cascade is not None:
+        ckpt = get_checkpoint(config["checkpoints"], prefix, checkpoints[-1])
+        screened = cascade.timed(
+            "screen",
+            infer_detections,
+            cascade.get_model(ckpt, device),
+            loader,
+            set(inferred),
+            config,
+            cascade.img_size,
+        )
+        settled, audited = cascade.screen(screened)
+    escalated = [path for path in inferred if path not in settled or path in audited]
+    audit_detections = {path: list() for path in audited}
 
     for epoch in tqdm(checkpoints, "Benchmarking epochs", disable=silent):
         ckpt = get_checkpoint(config["checkpoints"], prefix, epoch)
-        model.load_state_dict(torch.load(ckpt, map_location=model.device))
-
-        for (img_paths, input_imgs) in loader:
-            path = img_paths[0]
-            if path not in detections_by_img.keys():
-                detections_by_img[path] = None
-
-            while True:
-                try:
-                    detections = evaluate.detect(
-                        input_imgs, config["conf_thres"], model, config["nms_thres"]
-                    )
-                    break
-                except RuntimeError:
-                    # Cuda out of memory
-                    model.to(yoloutils.get_device())
-                    yoloutils.clear_vram()
-
-            detections = [d for d in detections if d is not None]
-
-            if len(detections) == 0:
+        ckpt_detections = store.load(ckpt, escalated)
+
+        # Only infer on images without saved detections from this checkpoint
+        missing = set(escalated) - set(ckpt_detections.keys())
+        if len(missing) != 0:
+            if model is None:
+                model_def = yoloutils.parse_model_config(config["model_config"])
+                model = models.get_eval_model(
+                    model_def, config["img_size"], device=device
+                )
+                yoloutils.clear_vram()
+            model.load_state_dict(
+                shared.load_state_dict(ckpt, map_location=model.device)
+            )
+            if cascade is None:
+                new_detections = infer_detections(model, loader, missing, config)
+            else:
+                new_detections = cascade.timed(
+                    "full", infer_detections, model, loader, missing, config
+                )
+                cascade.counts["inferred"] += len(missing)
+            store.save(ckpt, new_detections)
+            ckpt_detections.update(new_detections)
+
+        for path in audited:
+            audit_detections[path].append(ckpt_detections[path])
+        for path in settled.keys() - audited:
+            ckpt_detections[path] = settled[path]
+
+        for path in paths:
+            detections = ckpt_detections[plan[path]]
+            if detections is None:
                 continue
-
-            detections = torch.stack(detections)
             if detections_by_img[path] is None:
                 detections_by_img[path] = detections
             else:
                 detections_by_img[path] = torch.cat(
                     (detections_by_img[path], detections), 1
                 )
+
+    if cascade is not None:
+        for path in audited:
+            cascade.add_audit(settled[path], audit_detections[path])
+        cascade.report()
     return detections_by_img
 
 
-def make_results_df(config, img_folder, detections_by_img, total_epochs):
-    metrics = [
-        "file",
-        "actual",
-        "detected",
-        "conf",
-        "conf_std",
-        "hit",
-    ]
+def infer_detections(model, loader, paths, config, img_size=None):
+    """Get a dictionary of the detections of a model on the given images of a loader,
+    which are None for images without detections. Images are downscaled first if a
+    smaller image size is given."""
+    detections_by_img = dict()
+    for (img_paths, input_imgs) in loader:
+        path = img_paths[0]
+        if path not in paths:
+            continue
+        if img_size is not None and img_size != input_imgs.shape[-1]:
+            input_imgs = F.interpolate(
+                evaluate.to_model_input(input_imgs, model.device), img_size, mode="area"
+            )
+
+        while True:
+            try:
+                detections = evaluate.detect(
+                    input_imgs, config["conf_thres"], model, config["nms_thres"]
+                )
+                break
+            except RuntimeError:
+                # Cuda out of memory
+                model.to(yoloutils.get_device(refresh=True))
+                yoloutils.clear_vram()
+
+        detections = [d for d in detections if d is not None]
+        detections_by_img[path] = (
+            torch.stack(detections) if len(detections) != 0 else None
+        )
+    return detections_by_img
 
-    results = pd.DataFrame(columns=metrics)
+
+def make_results_df(config, img_folder, detections_by_img, total_epochs):
     classes = utils.load_classes(config["class_list"])
+    label_index = img_folder.get_label_index(detections_by_img.keys())
+
+    # Rows are buffered by column and converted to a dataframe once
+    columns = {metric: list() for metric in rload.COLUMNS}
+
+    def add_row(path, actual, detected, conf, conf_std):
+        columns["file"].append(path)
+        columns["actual"].append(actual)
+        columns["detected"].append(detected)
+        columns["conf"].append(conf)
+        columns["conf_std"].append(conf_std)
+        columns["hit"].append(actual == detected)
 
     for path, detections in detections_by_img.items():
-        ground_truths = img_folder.get_classes(utils.get_label_path(path))
+        targets = label_index[path]
+        labels = [int(c) for c in targets[:, 1].tolist()]
+        ground_truths = [c for c in labels if c in range(img_folder.num_classes)]
         detection_pairs = list()
         if detections is not None:
             region_detections, regions_std = yoloutils.group_average_bb(
@@ -104,9 +208,8 @@ def make_results_df(config, img_folder, detections_by_img, total_epochs):
                     label = None
                 detection_pairs = [(label, region_detections[0])]
             else:
-                test_img = LabeledSet([path], len(classes))
                 detection_pairs = evaluate.match_detections(
-                    test_img, region_detections.unsqueeze(0), config
+                    targets, region_detections.unsqueeze(0), config
                 )
 
         for (truth, box) in detection_pairs:
@@ -115,53 +218,53 @@ def make_results_df(config, img_folder, detections_by_img, total_epochs):
             obj_conf, class_conf, pred_class = box.numpy()[4:]
             obj_std, class_std = regions_std[round(float(class_conf), 3)]
 
-            row = {
-                "file": path,
-                "detected": classes[int(pred_class)],
-                "actual": classes[int(truth)] if truth is not None else "",
-                "conf": obj_conf * class_conf,
-                "conf_std": math.sqrt(obj_std ** 2 + class_std ** 2),
-            }
-            row["hit"] = row["actual"] == row["detected"]
-
-            results = results.append(row, ignore_index=True)
+            add_row(
+                path,
+                classes[int(truth)] if truth is not None else "",
+                classes[int(pred_class)],
+                float(obj_conf * class_conf),
+                math.sqrt(obj_std ** 2 + class_std ** 2),
+            )
 
             if truth is not None:
                 ground_truths.remove(int(truth))
 
         # Add rows for those missing detections
         for truth in ground_truths:
-            row = {
-                "file": path,
-                "detected": "",
-                "actual": classes[int(truth)],
-                "conf": 0.0,
-                "hit": False,
-                "conf_std": 0.0,
-            }
-
-            results = results.append(row, ignore_index=True)
-    return results
+            add_row(path, classes[int(truth)], "", 0.0, 0.0)
+
+    return pd.DataFrame(
+        {
+            "file": np.array(columns["file"], dtype=object),
+            "actual": np.array(columns["actual"], dtype=object),
+            "detected": np.array(columns["detected"], dtype=object),
+            "conf": np.array(columns["conf"], dtype=np.float64),
+            "conf_std": np.array(columns["conf_std"], dtype=np.float64),
+            "hit": np.array(columns["hit"], dtype=bool),
+        },
+        columns=rload.COLUMNS,
+    )
 
 
-def benchmark_avg(img_folder, prefix, start, end, total_epochs, config, roll=False):
+def benchmark_avg(
+    img_folder, prefix, start, end, total_epochs, config, roll=False, device=None
+):
     loader = DataLoader(
-        img_folder, batch_size=1, shuffle=False, num_workers=config["n_cpu"],
+        img_folder,
+        batch_size=1,
+        shuffle=False,
+        # Cached images are already decoded, so worker processes would only add copies
+        num_workers=0 if len(img_folder.img_cache) != 0 else config["n_cpu"],
     )
 
-    if roll:
-        checkpoints_i = list(range(max(1, end - total_epochs + 1), end + 1))
-    else:
-        checkpoints_i = list(
-            sorted(set(np.linspace(start, end, total_epochs, dtype=np.dtype(np.int16))))
-        )
+    checkpoints_i = get_checkpoint_epochs(start, end, total_epochs, roll)
 
     single = total_epochs == 1
     if not single:
         print("Benchmarking on epochs", checkpoints_i)
 
     detections_by_img = get_img_detections(
-        checkpoints_i, prefix, config, loader, single
+        checkpoints_i, prefix, config, loader, single, device
     )
 
     results = make_results_df(config, img_folder, detections_by_img, total_epochs)
@@ -170,6 +273,11 @@ def benchmark_avg(img_folder, prefix, start, end, total_epochs, config, roll=Fal
 
 
 def save_results(results, filename):
+    """Save benchmark results in a columnar .npz file, or as a CSV for other extensions."""
+    if filename.endswith(".npz"):
+        rload.write_columns(results, filename)
+        return
+
     output = open(filename, "w+")
 
     metrics = results.columns.tolist()
@@ -189,7 +297,7 @@ def series_benchmark_loss(img_folder, prefix, start, end, delta, config, filenam
 
     for epoch in tqdm(range(start, end + 1, delta), "Benchmarking epochs"):
         ckpt = get_checkpoint(config["checkpoints"], prefix, epoch)
-        model.load_state_dict(torch.load(ckpt, map_location=model.device))
+        model.load_state_dict(shared.load_state_dict(ckpt, map_location=model.device))
 
         results = evaluate.get_results(model, img_folder, config, list(), silent=True)
         out.write(f"{epoch},{results['val_loss']},{results['val_mAP']}\n")
@@ -214,12 +322,7 @@ def simple_benchmark_avg(
 
     classes = utils.load_classes(config["class_list"])
 
-    if roll:
-        checkpoints_i = list(range(max(1, end - total_epochs + 1), end + 1))
-    else:
-        checkpoints_i = list(
-            sorted(set(np.linspace(start, end, total_epochs, dtype=np.dtype(np.int16))))
-        )
+    checkpoints_i = get_checkpoint_epochs(start, end, total_epochs, roll)
 
     single = total_epochs == 1
 
@@ -354,6 +457,7 @@ def series_benchmark(config, opt, prefix):
             start = epoch_splits[i - 1]
 
         for epoch in tqdm(range(start, split + 1, opt.delta)):
+            out_names = dict()
             for name, img_folder in test_sets.items():
                 # Benchmark both iterations sets at the split mark
                 if (epoch == start and "cur_iter" not in name) or (
@@ -361,21 +465,38 @@ def series_benchmark(config, opt, prefix):
                 ):
                     continue
 
-                out_name = f"{out_folder}/{name}_{epoch}.csv"
-                if os.path.exists(out_name):
-                    continue
+                out_name = f"{out_folder}/{name}_{epoch}{rload.get_bench_ext(config)}"
+                if not os.path.exists(rload.get_bench_file(out_name)):
+                    out_names[name] = out_name
 
-                if opt.roll_avg:
-                    result_df = benchmark_avg(
-                        img_folder, prefix, 1, epoch, num_ckpts, config, roll=True
-                    )
-                elif opt.avg:
-                    result_df = benchmark_avg(
-                        img_folder, prefix, 1, epoch, num_ckpts, config
-                    )
-                else:
-                    result_df = benchmark(img_folder, prefix, epoch, config)
-                save_results(result_df, out_name)
+            if len(out_names) == 0:
+                continue
+
+            # Test sets overlap, so their union is benchmarked once and split up
+            img_folder = get_union_set([test_sets[name] for name in out_names.keys()])
+            if opt.roll_avg:
+                result_df = benchmark_avg(
+                    img_folder, prefix, 1, epoch, num_ckpts, config, roll=True
+                )
+            elif opt.avg:
+                result_df = benchmark_avg(
+                    img_folder, prefix, 1, epoch, num_ckpts, config
+                )
+            else:
+                result_df = benchmark(img_folder, prefix, epoch, config)
+
+            for name, out_name in out_names.items():
+                in_set = result_df["file"].isin(test_sets[name].imgs)
+                save_results(result_df[in_set], out_name)
+
+
+def get_union_set(img_folders):
+    """Get a LabeledSet of the images in any of the given LabeledSets."""
+    imgs = set()
+    for img_folder in img_folders:
+        imgs.update(img_folder.imgs)
+    num_classes = max(img_folder.num_classes for img_folder in img_folders)
+    return LabeledSet(list(imgs), num_classes)
 
 
 def benchmark_next_batch(prefix, config, opt):
@@ -393,7 +514,7 @@ def benchmark_next_batch(prefix, config, opt):
     def get_filename(i, end_epoch):
         filename = f"{out_dir}/{prefix}{i}_benchmark_"
         filename += "roll_" if opt.roll_avg else "avg_"
-        filename += f"1_{end_epoch}.csv"
+        filename += f"1_{end_epoch}{rload.get_bench_ext(config)}"
         return filename
 
     benchmark_batch_splits(
@@ -431,7 +552,7 @@ def benchmark_batch_test_set(prefix, config, opt, reserve_batches=0):
         filename = f"{config['output']}/{prefix}{i}_benchmark_"
         if opt.roll_avg is None:
             filename += "avg_"
-        filename += f"test_{end_epoch}.csv"
+        filename += f"test_{end_epoch}{rload.get_bench_ext(config)}"
         return filename
 
     batch_folders = [test_folder] * len(epoch_splits)
@@ -460,7 +581,7 @@ def benchmark_batch_splits(
 
         filename = filename_func(i, end_epoch)
 
-        if os.path.exists(filename):
+        if os.path.exists(rload.get_bench_file(filename)):
             continue
         if opt.roll_avg is not None:
             results = benchmark_avg(
@@ -0,0 +1,203 @@
+"""
+Cascade inference for benchmarks, screening frames with a cheaper model first.
+
+A small Darknet model (cascade_model_config), or the model being benchmarked at a reduced
+image size (cascade_img_size), scores every frame. A frame's confidence is that of its
+most confident detection, or 0 without detections. Frames whose confidence falls within
+[cascade_min_conf, cascade_max_conf], around the thresholds used for sampling, are
+escalated to the full model and the checkpoint ensemble. The screening detections of
+other frames are used as the detections of each checkpoint.
+
+A fraction of the settled frames (cascade_audit) is also escalated, to measure how often
+the screening model agrees with the ensemble.
+"""
+
+import os
+import time
+import hashlib
+
+import numpy as np
+
+from retrain import checkpoints
+from yolov3 import models
+from yolov3 import shared
+from yolov3 import utils as yoloutils
+
+
+def get_cascade(config):
+    """Get the cascade set in the configuration, or None if cascade inference is
+    disabled."""
+    if not any(
+        key in config.keys() for key in ("cascade_img_size", "cascade_model_config")
+    ):
+        return None
+    return Cascade(config)
+
+
+def get_option(config, key, default):
+    return config[key] if key in config.keys() else default
+
+
+class Cascade:
+    """Screening stage of cascade inference and statistics of its decisions.
+
+    Arguments
+        config  configuration with the cascade options and the image size of the full
+                model
+    """
+
+    def __init__(self, config):
+        self.img_size = get_option(config, "cascade_img_size", config["img_size"])
+        self.scale = config["img_size"] / self.img_size
+        self.model_config = get_option(
+            config, "cascade_model_config", config["model_config"]
+        )
+        self.weights = get_option(config, "cascade_weights", None)
+        check_weights(self.weights, "cascade_model_config" in config.keys())
+        self.min_conf = get_option(config, "cascade_min_conf", 0.3)
+        self.max_conf = get_option(config, "cascade_max_conf", 0.7)
+        self.audit = get_option(config, "cascade_audit", 0.1)
+        self.model = None
+        self.reset()
+
+    def reset(self):
+        self.times = {"screen": 0.0, "full": 0.0}
+        self.counts = {"screened": 0, "escalated": 0, "inferred": 0}
+        self.audited = list()
+
+    def get_model(self, ckpt, device=None):
+        """Get the screening model, with the weights of the given checkpoint unless
+        separate weights are set."""
+        if self.model is None:
+            model_def = yoloutils.parse_model_config(self.model_config)
+            self.model = models.get_eval_model(
+                model_def, self.img_size, self.weights, device
+            )
+        if self.weights is None:
+            self.model.load_state_dict(
+                shared.load_state_dict(ckpt, map_location=self.model.device)
+            )
+        return self.model
+
+    def get_decision(self, conf):
+        """Get whether a confidence is below (-1), within (0) or above (1) the range of
+        escalated confidences."""
+        if conf < self.min_conf:
+            return -1
+        return 1 if conf > self.max_conf else 0
+
+    def is_audited(self, path):
+        # Chosen by hash, so the same frames are audited in every benchmark
+        digest = hashlib.sha1(path.encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "big") < self.audit * 2 ** 32
+
+    def screen(self, detections):
+        """Decide which frames to escalate from a dictionary of their screening
+        detections, in the coordinates of the screening image size.
+
+        Returns a dictionary of settled frames and their detections, scaled to the full
+        image size, and the set of settled frames that are audited.
+        """
+        settled = dict()
+        for path, img_detections in detections.items():
+            if img_detections is not None:
+                img_detections = img_detections.clone()
+                img_detections[..., :4] *= self.scale
+            if self.get_decision(get_conf(img_detections)) != 0:
+                settled[path] = img_detections
+
+        self.counts["screened"] += len(detections)
+        self.counts["escalated"] += len(detections) - len(settled)
+        return settled, {path for path in settled.keys() if self.is_audited(path)}
+
+    def add_audit(self, screened, ensemble):
+        """Compare the screening detections of a settled frame with the detections of
+        each checkpoint of the ensemble."""
+        confs = [get_conf(detections) for detections in ensemble]
+        self.audited.append(
+            (
+                get_conf(screened),
+                get_class(screened),
+                np.mean(confs),
+                get_class(ensemble[int(np.argmax(confs))]),
+            )
+        )
+
+    def timed(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.times[stage] += time.perf_counter() - start
+        return result
+
+    def report(self):
+        """Print the timing of each stage and the agreement of audited frames."""
+        screened = self.counts["screened"]
+        escalated = self.counts["escalated"]
+        if screened == 0:
+            return
+        print(
+            f"Cascade: screened {screened} frames in {self.times['screen']:.1f}s, "
+            f"escalated {escalated} ({escalated / screened:.0%}); "
+            f"full model ran {self.counts['inferred']} inferences (frames times "
+            f"checkpoints) in {self.times['full']:.1f}s"
+        )
+
+        if len(self.audited) != 0:
+            audited = np.array(
+                [
+                    (
+                        self.get_decision(conf) == self.get_decision(ensemble_conf),
+                        conf_class == ensemble_class,
+                        abs(conf - ensemble_conf),
+                    )
+                    for conf, conf_class, ensemble_conf, ensemble_class in self.audited
+                ]
+            )
+            print(
+                f"Cascade agreement on {len(audited)} audited frames: "
+                f"{audited[:, 0].mean():.0%} same decision, "
+                f"{audited[:, 1].mean():.0%} same class, "
+                f"mean confidence difference {audited[:, 2].mean():.3f}"
+            )
+
+
+def check_weights(weights, separate_model):
+    """Check that the weights of a separate screening model are given as a PyTorch
+    state dictionary, raising a ValueError otherwise."""
+    if weights is None:
+        if separate_model:
+            raise ValueError(
+                "cascade_weights must be set to the checkpoint of cascade_model_config, "
+                "since the benchmarked checkpoints do not fit another architecture"
+            )
+        return
+
+    if not os.path.isfile(weights):
+        raise ValueError(f"cascade_weights {weights} does not exist")
+    if weights.endswith(".weights"):
+        raise ValueError(
+            f"cascade_weights {weights} is a Darknet weights file. Load it with "
+            "Darknet.load_darknet_weights() and save the model's state_dict() instead"
+        )
+    try:
+        state_dict = checkpoints.load_state_dict(weights, map_location="cpu")
+    except Exception as e:
+        raise ValueError(
+            f"cascade_weights {weights} is not a PyTorch checkpoint"
+        ) from e
+    if not isinstance(state_dict, dict):
+        raise ValueError(f"cascade_weights {weights} is not a model state dictionary")
+
+
+def get_conf(detections):
+    """Get the confidence of the most confident detection, or 0 without detections."""
+    if detections is None:
+        return 0.0
+    return float((detections[..., 4] * detections[..., 5]).max())
+
+
+def get_class(detections):
+    if detections is None:
+        return None
+    scores = (detections[..., 4] * detections[..., 5]).flatten()
+    return int(detections[..., 6].flatten()[scores.argmax()])
@@ -1,4 +1,5 @@
 import os
+import sqlite3
 from glob import glob
 
 import matplotlib.pyplot as plt
@@ -7,7 +8,7 @@ import pandas as pd
 import numpy as np
 from sklearn.linear_model import LinearRegression
 
-from retrain import utils
+from retrain import utils, checkpoints
 import analysis.results as rload
 
 
@@ -43,7 +44,7 @@ def make_conf_histogram(results, filename):
 
     colors = ["lightgreen", "red"]
     for i, res in enumerate(results):
-        hit_miss = [[row["conf"] for row in data] for data in res.hits_misses()]
+        hit_miss = res.hits_misses()
 
         axs[i][0].hist(hit_miss[0], bins=15, color=colors[0], range=(0, 1))
         axs[i][1].hist(hit_miss[1], bins=15, color=colors[1], range=(0, 1))
@@ -100,14 +101,10 @@ def plot_multiline(xy_pairs, xlab=str(), ylab=str(), vert_lines=None):
     plt.show()
 
 
-def get_conf_data(result_list):
-    return [row["conf"] for row in result_list]
-
-
 def show_overall_hist(results):
     acc = round(rload.mean_metric(results[:-1], "accuracy"), 3)
     prec = round(rload.mean_metric(results[:-1], "precision"), 3)
-    hit_miss = [get_conf_data(data) for data in results[-1].hits_misses()]
+    hit_miss = results[-1].hits_misses()
 
     colors = ["lightgreen", "red"]
     plt.hist(hit_miss[0], bins=10, color=colors[0], range=(0.0, 1.0))
@@ -134,6 +131,10 @@ def make_conf_matrix(conf_mat, classes, filename):
     df.to_csv(filename)
 
 
+SERIES_STATS_NAME = "series-stats.sqlite"
+SERIES_METRICS = ["prec", "acc", "conf", "conf_std", "detect_conf_std", "recall"]
+
+
 def get_avg_metric_dict(results):
     return {
         "prec": rload.mean_metric(results, "precision"),
@@ -145,6 +146,69 @@ def get_avg_metric_dict(results):
     }
 
 
+def update_series_stats(out_folder, benchmarks, conf_thresh):
+    """Get a dataframe of the average metrics of each series benchmark, given as a list
+    of test set names, epochs, and benchmark files.
+
+    Metrics are kept in an SQLite database in the series folder, indexed by test set
+    and epoch, and only benchmarks that are new or were modified since their metrics
+    were computed are loaded.
+    """
+    conn = sqlite3.connect(f"{out_folder}/{SERIES_STATS_NAME}", timeout=60)
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats (test_set TEXT, epoch INTEGER, "
+            "mtime INTEGER, conf_thresh REAL, "
+            + ", ".join(f"{metric} REAL" for metric in SERIES_METRICS)
+            + ", PRIMARY KEY (test_set, epoch))"
+        )
+    saved = {
+        (row[0], row[1]): row[2:]
+        for row in conn.execute(
+            "SELECT test_set, epoch, mtime, conf_thresh, "
+            + ", ".join(SERIES_METRICS)
+            + " FROM stats"
+        )
+    }
+
+    stale = list()
+    for name, epoch, out_name in benchmarks:
+        mtime = os.stat(out_name).st_mtime_ns
+        row = saved.get((name, epoch))
+        if row is None or row[:2] != (mtime, conf_thresh):
+            stale.append((name, epoch, out_name, mtime))
+
+    if len(stale) != 0:
+        print(f"Updating metrics of {len(stale)} of {len(benchmarks)} benchmarks")
+        loaded = rload.load_many(
+            [out_name for _, _, out_name, _ in stale],
+            by_actual=False,
+            conf_thresh=conf_thresh,
+        )
+        rows = list()
+        for (name, epoch, _, mtime), (epoch_res, _) in zip(stale, loaded):
+            metrics = get_avg_metric_dict(epoch_res)
+            row = (mtime, conf_thresh, *[metrics[m] for m in SERIES_METRICS])
+            saved[(name, epoch)] = row
+            rows.append((name, epoch, *row))
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO stats VALUES ("
+                + ", ".join("?" * (len(SERIES_METRICS) + 4))
+                + ")",
+                rows,
+            )
+    conn.close()
+
+    results = list()
+    for name, epoch, _ in benchmarks:
+        metrics = saved[(name, epoch)][2:]
+        results.append(
+            {"test_set": name, "epoch": epoch, **dict(zip(SERIES_METRICS, metrics))}
+        )
+    return pd.DataFrame.from_dict(results, orient="columns")
+
+
 def display_series(config, opt):
     names = [
         "init",
@@ -157,28 +221,24 @@ def display_series(config, opt):
     if opt.batch_test is not None:
         names.append("batch_test")
 
-    results = list()
-
     out_folder = f"{config['output']}/{opt.prefix}-series"
     if opt.avg or opt.roll_avg:
         out_folder += "-roll-avg" if opt.roll_avg else "-avg"
+    benchmarks = list()
     for name in names:
         is_baseline = opt.prefix == "init" or "baseline" in opt.prefix
         start_epoch = 1 if is_baseline else epoch_splits[0]
         for i in range(start_epoch, epoch_splits[-1], opt.delta):
-            out_name = f"{out_folder}/{name}_{i}.csv"
+            out_name = rload.get_bench_file(
+                f"{out_folder}/{name}_{i}{rload.get_bench_ext(config)}"
+            )
 
             if not os.path.exists(out_name):
                 print(f"Skipping epoch {i} due to missing benchmark")
                 continue
+            benchmarks.append((name, i, out_name))
 
-            epoch_res, _ = rload.load_data(
-                out_name, by_actual=False, conf_thresh=config["pos_thres"]
-            )
-            new_row = {"test_set": name, "epoch": i, **get_avg_metric_dict(epoch_res)}
-            results.append(new_row)
-
-    results = pd.DataFrame.from_dict(results, orient="columns")
+    results = update_series_stats(out_folder, benchmarks, config["pos_thres"])
 
     results.to_csv(f"{out_folder}/{opt.prefix}-series-stats.csv")
 
@@ -208,7 +268,7 @@ def visualize_conf(prefix, benchmark, filter_sample=False, pos_thres=0.5):
         sampled_imgs = glob(f"{folder}/{prefix}*_sample_{epoch}.txt")[0]
         kwargs["filter"] = sampled_imgs
 
-    results, conf_mat = rload.load_data(
+    results, conf_mat = rload.load_cached(
         benchmark, by_actual=False, conf_thresh=pos_thres, **kwargs
     )
 
@@ -231,27 +291,37 @@ def tabulate_batch_samples(
     for each batched sample using existing testing data."""
     bench_str = f"{config['output']}/{prefix}*_benchmark" + bench_suffix
 
-    benchmarks = utils.sort_by_epoch(bench_str)
-    checkpoints = utils.sort_by_epoch(f"{config['checkpoints']}/{prefix}*.pth")
+    benchmarks = sorted(
+        (file for file in rload.glob_bench_files(bench_str) if file[-5].isdigit()),
+        key=utils.get_epoch,
+    )
+    last_epoch = checkpoints.get_registry(config["checkpoints"]).get_epochs(prefix)[-1]
 
-    data = list()
+    loaded, filters = list(), list()
     for i, benchmark in enumerate(benchmarks):
-        kwargs = dict()
         if filter_samp and prefix != "init":
             sampled_imgs = glob(f"{config['output']}/{prefix}{i}_sample*")
             if len(sampled_imgs) == 0:
                 continue
-            kwargs["filter"] = sampled_imgs[0]
-        results, _ = rload.load_data(
-            benchmark,
-            by_actual=False,
-            add_all=False,
-            conf_thresh=config["pos_thres"],
-            **kwargs,
-        )
+            filters.append(sampled_imgs[0])
+        else:
+            filters.append(None)
+        loaded.append(i)
+
+    # Benchmarks are loaded in parallel, and reused by later calls
+    all_results = rload.load_many(
+        [benchmarks[i] for i in loaded],
+        filters,
+        by_actual=False,
+        add_all=False,
+        conf_thresh=config["pos_thres"],
+    )
 
+    data = list()
+    for i, (results, _) in zip(loaded, all_results):
+        benchmark = benchmarks[i]
         if i == len(benchmarks) - 1:
-            train_len = utils.get_epoch(checkpoints[-1]) - utils.get_epoch(benchmark)
+            train_len = last_epoch - utils.get_epoch(benchmark)
         else:
             train_len = utils.get_epoch(benchmarks[i + 1]) - utils.get_epoch(benchmark)
 
@@ -333,7 +403,7 @@ def compare_benchmarks(
             indep_var = tabulate_batch_samples(
                 config,
                 prefix,
-                bench_suffix="_avg_1_*.csv",
+                bench_suffix="_avg_1_*" + rload.get_bench_ext(config),
                 silent=True,
                 filter_samp=True,
             )
@@ -359,7 +429,7 @@ def compare_benchmarks(
 
 
 def display_benchmark(file, config):
-    results, _ = rload.load_data(
+    results, _ = rload.load_cached(
         file, by_actual=False, add_all=False, conf_thresh=config["pos_thres"],
     )
 
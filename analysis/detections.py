@@ -0,0 +1,161 @@
+"""
+Cache of the raw detections of checkpoints on images, saved before they are averaged.
+
+Detections are keyed by the content hash of the checkpoint, the path and modification
+time of the image, and the image size and thresholds used for inference. Identical
+inference is therefore only run once, whether it is repeated by benchmarks with
+overlapping (e.g. rolling) averages, by sampling methods benchmarking the same baseline
+checkpoint, or by the analysis tool benchmarking a run again.
+
+The cache is an SQLite database shared by all processes of a run. Once it grows past
+its size limit, the least recently used detections are evicted.
+"""
+
+import io
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+import torch
+
+from retrain import manifest
+
+CACHE_NAME = "detections.sqlite"
+
+_stores = dict()
+
+
+def get_store(config):
+    """Get the detection cache set in the configuration, or the cache in the output
+    folder by default."""
+    if "detection_cache" in config.keys():
+        path = config["detection_cache"]
+    else:
+        path = f"{config['output']}/{CACHE_NAME}"
+    path = os.path.realpath(path)
+
+    if path not in _stores.keys():
+        max_mb = (
+            config["detection_cache_mb"]
+            if "detection_cache_mb" in config.keys()
+            else 1024
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _stores[path] = DetectionStore(path, config, int(max_mb) * 2 ** 20)
+    return _stores[path]
+
+
+class DetectionStore:
+    """Content-addressed store of the detections of each checkpoint on each image.
+
+    Arguments
+        path       path of the SQLite database
+        config     configuration with the image size and thresholds used for inference
+        max_bytes  size of the stored detections past which old ones are evicted
+    """
+
+    def __init__(self, path, config, max_bytes=2 ** 30):
+        self.run = manifest.get_manifest(config)
+        self.settings = (config["img_size"], config["conf_thres"], config["nms_thres"])
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS detections "
+                "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS detections_used ON detections (used)"
+            )
+
+    def get_keys(self, ckpt, paths):
+        """Get a dictionary of image paths and the keys of their detections by a
+        checkpoint."""
+        ckpt_digest = self.run.get_digest(ckpt)
+        keys = dict()
+        for path in paths:
+            key = (ckpt_digest, os.path.realpath(path), os.stat(path).st_mtime_ns)
+            key = repr(key + self.settings).encode("utf-8")
+            keys[path] = hashlib.sha1(key).hexdigest()
+        return keys
+
+    def load(self, ckpt, paths):
+        """Get a dictionary of the cached detections of a checkpoint on the given images.
+        Images without cached detections are left out, while images the checkpoint made
+        no detections on map to None."""
+        keys = self.get_keys(ckpt, paths)
+        paths_by_key = {key: path for path, key in keys.items()}
+        rows = list()
+        key_list = list(paths_by_key.keys())
+
+        with self.lock:
+            # SQLite limits the number of parameters of a query
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i : i + 500]
+                params = ",".join("?" * len(chunk))
+                rows += self.conn.execute(
+                    f"SELECT key, value FROM detections WHERE key IN ({params})", chunk
+                ).fetchall()
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE detections SET used = ? WHERE key = ?",
+                    [(time.time(), key) for key, _ in rows],
+                )
+
+        return {paths_by_key[key]: decode(value) for key, value in rows}
+
+    def save(self, ckpt, detections):
+        """Add detections of a checkpoint, as a dictionary of image paths and detection
+        tensors (or None), to the cache."""
+        keys = self.get_keys(ckpt, detections.keys())
+        rows = list()
+        for path, img_detections in detections.items():
+            value = encode(img_detections)
+            size = 0 if value is None else len(value)
+            rows.append((keys[path], value, size, time.time()))
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?)", rows
+            )
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used detections until the cache is within its
+        size limit."""
+        with self.lock:
+            total = self.conn.execute("SELECT SUM(size) FROM detections").fetchone()[0]
+            if total is None or total <= self.max_bytes:
+                return
+
+            # Evict down to 90% of the limit, so the next saves do not evict again
+            excess = total - int(0.9 * self.max_bytes)
+            evicted = list()
+            rows = self.conn.execute(
+                "SELECT key, size FROM detections ORDER BY used"
+            ).fetchall()
+            for key, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append((key,))
+                excess -= size
+            with self.conn:
+                self.conn.executemany("DELETE FROM detections WHERE key = ?", evicted)
+
+
+def encode(detections):
+    if detections is None:
+        return None
+    buffer = io.BytesIO()
+    np.save(buffer, detections.numpy())
+    return buffer.getvalue()
+
+
+def decode(value):
+    if value is None:
+        return None
+    return torch.from_numpy(np.load(io.BytesIO(value)))
@@ -1,66 +1,242 @@
+import os
+import glob
+import threading
 from math import sqrt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import csv
-import itertools
 import statistics as stats
-from sklearn.metrics import confusion_matrix
+import numpy as np
+import pandas as pd
 
 from retrain import utils
 
+COLUMNS = ["file", "actual", "detected", "conf", "conf_std", "hit"]
+CATEGORICAL = ["file", "actual", "detected"]
+CACHE_SIZE = 2048
+
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+_warned_csv = False
+
+
+def get_bench_ext(config):
+    """Get the file extension of benchmark files, either npz (default) or csv."""
+    if "bench_format" in config.keys():
+        return f".{config['bench_format']}"
+    return ".npz"
+
+
+def get_bench_file(filename):
+    """Get the path of a benchmark file, or of a CSV benchmark in its place if an .npz
+    file does not exist. CSV benchmarks were the default before .npz files, so runs
+    from earlier versions are read instead of being benchmarked again."""
+    global _warned_csv
+    if not filename.endswith(".npz") or os.path.exists(filename):
+        return filename
+
+    csv_filename = f"{filename[:-4]}.csv"
+    if not os.path.exists(csv_filename):
+        return filename
+    if not _warned_csv:
+        print("Reading CSV benchmarks, since .npz benchmarks were not found")
+        _warned_csv = True
+    return csv_filename
+
+
+def glob_bench_files(pattern):
+    """Get the sorted benchmark files matching a glob pattern, including CSV benchmarks
+    without an .npz counterpart if the pattern matches .npz files."""
+    filenames = glob.glob(pattern)
+    if pattern.endswith(".npz"):
+        filenames += [
+            get_bench_file(f"{filename[:-4]}.npz")
+            for filename in glob.glob(f"{pattern[:-4]}.csv")
+            if not os.path.exists(f"{filename[:-4]}.npz")
+        ]
+    return sorted(filenames)
+
+
+def write_columns(results, filename):
+    """Save a dataframe of benchmark results as NumPy arrays in an .npz file, with
+    string columns stored as categorical codes."""
+    arrays = dict()
+    for col in CATEGORICAL:
+        codes, uniques = pd.factorize(results[col].astype(str), sort=True)
+        arrays[f"{col}_codes"] = codes.astype(np.int32)
+        values = np.asarray(uniques, dtype=str)
+        arrays[f"{col}_values"] = np.char.encode(values, "utf-8")
+    arrays["conf"] = results["conf"].to_numpy(dtype=np.float64)
+    arrays["conf_std"] = results["conf_std"].to_numpy(dtype=np.float64)
+    arrays["hit"] = results["hit"].to_numpy(dtype=bool)
+
+    with open(filename, "wb") as out:
+        np.savez(out, **arrays)
+
+
+def read_columns(filename, columns=None, decode=True):
+    """Read the given columns of a benchmark file (.npz or .csv) into a dictionary of arrays.
+
+    Only the requested columns are read from .npz files. If decode is False, categorical
+    columns are returned as a tuple of integer codes and their values.
+    """
+    if columns is None:
+        columns = COLUMNS
+
+    if not filename.endswith(".npz"):
+        df = pd.read_csv(
+            filename,
+            usecols=lambda col: col in columns,
+            keep_default_na=False,
+            dtype={col: str for col in CATEGORICAL if col in columns},
+        )
+        data = dict()
+        for col in columns:
+            if col == "hit":
+                data[col] = df[col].astype(str).to_numpy() == "True"
+            elif col in CATEGORICAL:
+                codes, uniques = pd.factorize(df[col], sort=True)
+                data[col] = (
+                    df[col].to_numpy(dtype=str)
+                    if decode
+                    else (codes.astype(np.int32), np.asarray(uniques, dtype=str))
+                )
+            elif col in df.columns:
+                data[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).to_numpy()
+            else:
+                data[col] = np.zeros(len(df))
+        return data
+
+    data = dict()
+    with np.load(filename) as arrays:
+        for col in columns:
+            if col in CATEGORICAL:
+                codes = arrays[f"{col}_codes"]
+                values = np.char.decode(arrays[f"{col}_values"], "utf-8")
+                data[col] = values[codes] if decode else (codes, values)
+            else:
+                data[col] = arrays[col]
+    return data
+
 
 def load_data(output, by_actual=True, add_all=True, filter=None, conf_thresh=0.5):
-    samples = dict()
-    all_data = list()
+    cols = read_columns(output, decode=False)
+    file_ids, files = cols["file"]
+    actual = cols["actual"][1][cols["actual"][0]]
+    pred = cols["detected"][1][cols["detected"][0]]
+
+    if filter is not None:
+        keep = np.isin(files, list(set(utils.get_lines(filter))))[file_ids]
+        file_ids, actual, pred = file_ids[keep], actual[keep], pred[keep]
+        cols = {k: cols[k][keep] for k in ("conf", "conf_std", "hit")}
+
+    data = {
+        "file": file_ids,
+        "actual": actual,
+        "detected": pred,
+        "conf": cols["conf"].astype(np.float64),
+        "conf_std": cols["conf_std"].astype(np.float64),
+        "hit": cols["hit"].astype(bool),
+    }
+
+    # Group rows by class in a single pass, with classes in sorted order
+    key_vals = actual if by_actual else np.where(pred == str(), actual, pred)
+    class_names, class_ids = np.unique(key_vals, return_inverse=True)
+    order = np.argsort(class_ids, kind="stable")
+    bounds = np.cumsum(np.bincount(class_ids, minlength=len(class_names)))[:-1]
+
+    results = list()
+    for name, rows in zip(class_names.tolist(), np.split(order, bounds)):
+        class_data = {k: v[rows] for k, v in data.items()}
+        results.append(ClassResults(name, class_data, files, conf_thresh=conf_thresh))
+
+    mat = confusion_counts(actual, pred, class_names.tolist() + [""])
 
-    actual = list()
-    pred = list()
+    if add_all:
+        results.append(ClassResults("All", data, files, conf_thresh=conf_thresh))
 
-    with open(output, newline="\n") as csvfile:
-        reader = csv.DictReader(csvfile)
+    return results, mat
 
-        if filter is not None:
-            filter_list = utils.get_lines(filter)
 
-        for row in reader:
-            if filter is not None and row["file"] not in filter_list:
-                continue
-            actual.append(row["actual"])
-            pred.append(row["detected"])
-            all_data.append(row)
+def load_cached(output, by_actual=True, add_all=True, filter=None, conf_thresh=0.5):
+    """Load benchmark results like load_data(), reusing the results of an earlier call
+    if the benchmark and filter files have not changed since.
 
-            key_val = (
-                row["actual"]
-                if by_actual or row["detected"] == str()
-                else row["detected"]
-            )
+    The returned list of results may be modified, but the results in it are shared
+    between calls.
+    """
+    key = (os.path.realpath(output), os.stat(output).st_mtime_ns)
+    key += (by_actual, add_all, conf_thresh)
+    if filter is not None:
+        key += (os.path.realpath(filter), os.stat(filter).st_mtime_ns)
+
+    with _loaded_lock:
+        if key in _loaded.keys():
+            _loaded.move_to_end(key)
+            results, mat = _loaded[key]
+            return list(results), mat
+
+    results, mat = load_data(output, by_actual, add_all, filter, conf_thresh)
+    with _loaded_lock:
+        _loaded[key] = (results, mat)
+        while len(_loaded) > CACHE_SIZE:
+            _loaded.popitem(last=False)
+    return list(results), mat
+
+
+def load_many(outputs, filters=None, max_workers=8, **kwargs):
+    """Load many benchmark files with load_cached() on a thread pool, returning a list
+    of results and confusion matrices in the same order.
+
+    Arguments
+        outputs      benchmark files
+        filters      filter file for each benchmark file, or None to not filter
+        max_workers  number of threads to load files with
+        kwargs       keyword arguments of load_data()
+    """
+    if filters is None:
+        filters = [None] * len(outputs)
 
-            if key_val in samples.keys():
-                samples[key_val].append(row)
-            else:
-                samples[key_val] = [row]
+    def load(args):
+        return load_cached(args[0], filter=args[1], **kwargs)
 
-    samples = {k: samples[k] for k in sorted(samples)}
-    results = [ClassResults(k, v, conf_thresh=conf_thresh) for k, v in samples.items()]
-    mat = confusion_matrix(actual, pred, labels=list(samples.keys()) + [""])
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(load, zip(outputs, filters)))
 
-    if add_all:
-        results.append(ClassResults("All", all_data, conf_thresh=conf_thresh))
 
-    return results, mat
+def confusion_counts(actual, pred, labels):
+    """Compute a confusion matrix of actual (rows) and predicted (columns) labels in the
+    given order, ignoring labels not in the list."""
+    label_index = {label: i for i, label in enumerate(labels)}
+
+    indices = list()
+    for values in (actual, pred):
+        uniques, inverse = np.unique(values, return_inverse=True)
+        index = [label_index.get(label, -1) for label in uniques.tolist()]
+        indices.append(np.array(index, dtype=np.int64)[inverse])
+    valid = (indices[0] >= 0) & (indices[1] >= 0)
+
+    mat = np.zeros((len(labels), len(labels)), dtype=np.int64)
+    np.add.at(mat, (indices[0][valid], indices[1][valid]), 1)
+    return mat
 
 
 def mean_avg_conf(class_results):
     """Compute mean average confidence for a list of classes."""
     if len(class_results) == 0:
         return None
-    return stats.mean(stats.mean(res.get_confidences()) for res in class_results)
+    return stats.mean(float(np.mean(res.get_confidences())) for res in class_results)
 
 
 def mean_conf_std(class_results):
     """Compute the mean standard deviation of the confidences of each class."""
     if len(class_results) == 0:
         return None
-    class_vars = [stats.variance(res.get_confidences()) for res in class_results]
+    # Classes with a single confidence have no spread
+    class_vars = [
+        float(np.var(confs, ddof=1)) if len(confs) >= 2 else 0.0
+        for confs in (res.get_confidences() for res in class_results)
+    ]
     return sqrt(stats.mean(class_vars))
 
 
@@ -69,10 +245,9 @@ def mean_avg_detect_conf_std(class_results):
     deviations of each image's bounding boxes confidence."""
     if len(class_results) == 0:
         return None
-    mean_class_vars = list()
-    for res in class_results:
-        class_var = [conf ** 2 for conf in res.get_conf_stds()]
-        mean_class_vars.append(stats.mean(class_var))
+    mean_class_vars = [
+        float(np.mean(res.get_conf_stds() ** 2)) for res in class_results
+    ]
     return sqrt(stats.mean(mean_class_vars))
 
 
@@ -87,99 +262,107 @@ def mean_metric(class_results, metric):
 
 
 class ClassResults:
-    def __init__(self, name, output_rows, conf_thresh=0.5):
+    """Benchmark results for a class (or all classes), stored as arrays with one entry
+    per detection or missed ground truth."""
+
+    def __init__(self, name, data, files, conf_thresh=0.5):
+        """
+        Parameters:
+            name (str): name of the class, or "All"
+            data (dict): arrays for the file (as indices of files), actual, detected,
+                conf, conf_std, and hit columns of a benchmark
+            files (np.ndarray): image paths indexed by the file column
+            conf_thresh (float): minimum confidence for a detection to be positive
+        """
         self.name = name
-        self.condition = ["pos", "neg"]
-        self.actual = ["true", "false"]
-        self.data = dict()
-        self.pop = 0
-
-        for actual in self.actual:
-            for cond in self.condition:
-                self.data[f"{actual}_{cond}"] = list()
-
-        for row in output_rows:
-            row["conf"] = float(row["conf"])
-            try:
-                row["conf_std"] = float(row["conf_std"])
-            except (KeyError, ValueError):
-                row["conf_std"] = 0
-            if row["conf"] >= conf_thresh:
-                if row["hit"] == "True":
-                    result = "true_pos"
-                else:
-                    result = "false_pos"
-            else:
-                if row["hit"] == "True":
-                    result = "false_neg"
-                else:
-                    result = "true_neg"
-            self.data[result].append(row)
-            self.pop += 1
+        self.files = files
+        self.file_ids = data["file"]
+        self.actual = data["actual"]
+        self.detected = data["detected"]
+        self.conf = data["conf"]
+        self.conf_std = data["conf_std"]
+        self.hit = data["hit"]
+        self.pop = len(self.conf)
+
+        positive = self.conf >= conf_thresh
+        self.positive = positive
+        self.counts = {
+            "true_pos": int(np.count_nonzero(positive & self.hit)),
+            "false_pos": int(np.count_nonzero(positive & ~self.hit)),
+            "false_neg": int(np.count_nonzero(~positive & self.hit)),
+            "true_neg": int(np.count_nonzero(~positive & ~self.hit)),
+        }
+        self.num_files = len(np.unique(self.file_ids))
+
+        # Results grouped by outcome, in the order they were listed before results
+        # were stored as arrays, which samplers shuffle with a fixed seed
+        self.outcome_order = np.concatenate(
+            [
+                np.flatnonzero(positive & self.hit),
+                np.flatnonzero(~positive & ~self.hit),
+                np.flatnonzero(positive & ~self.hit),
+                np.flatnonzero(~positive & self.hit),
+            ]
+        )
+
+        true_pos, false_pos = self.counts["true_pos"], self.counts["false_pos"]
+        false_neg, true_neg = self.counts["false_neg"], self.counts["true_neg"]
+        self.metrics = {
+            "precision": true_pos / (true_pos + false_pos + 1e-16),
+            "recall": true_pos / (true_pos + false_neg + 1e-16),
+            "accuracy": (true_pos + true_neg) / self.pop,
+        }
 
     def __len__(self):
-        files = set()
-        for row in self.get_all():
-            files.add(row["file"])
-        return len(files)
+        return self.num_files
 
     def precision(self):
-        predicted_cond_pos = (
-            len(self.data["true_pos"]) + len(self.data["false_pos"]) + 1e-16
-        )
-        return len(self.data["true_pos"]) / predicted_cond_pos
+        return self.metrics["precision"]
 
     def recall(self):
-        return len(self.data["true_pos"]) / (
-            (len(self.data["true_pos"]) + len(self.data["false_neg"]) + 1e-16)
-        )
+        return self.metrics["recall"]
 
     def accuracy(self):
-        return (len(self.data["true_pos"]) + len(self.data["true_neg"])) / self.pop
+        return self.metrics["accuracy"]
 
     def hits_misses(self):
-        """Get a split list of hits and misses."""
-        all_results = [list(), list()]
-        for k, v in self.data.items():
-            if k in ("true_pos", "false_neg"):
-                all_results[0] += v
-            else:
-                all_results[1] += v
-        return all_results
+        """Get a split array of the confidences of hits and misses."""
+        return [self.conf[self.hit], self.conf[~self.hit]]
+
+    def get_files(self):
+        """Get the image path of each result."""
+        return self.files[self.file_ids]
 
     def get_all(self):
-        return list(itertools.chain.from_iterable(self.data.values()))
+        """Get a list of results as dictionaries, with keys for each benchmark column,
+        ordered by outcome (true positives, true negatives, false positives, then false
+        negatives)."""
+        order = self.outcome_order
+        rows = zip(
+            self.get_files()[order].tolist(),
+            self.actual[order].tolist(),
+            self.detected[order].tolist(),
+            self.conf[order].tolist(),
+            self.conf_std[order].tolist(),
+            self.hit[order].tolist(),
+        )
+        return [dict(zip(COLUMNS, row)) for row in rows]
 
     def get_confidences(self, thresh=0.0):
-        return [result["conf"] for result in self.get_all() if result["conf"] >= thresh]
+        return self.conf[self.conf >= thresh]
 
     def get_conf_stds(self):
-        return [result["conf_std"] for result in self.get_all()]
+        return self.conf_std
 
     def generate_prec_distrib(self, output, delta=0.05):
         """Generate a spreadsheet of confidence range vs. rolling precision."""
+        edges = np.arange(0.0, 1.0 + 1.5 * delta, delta)
+        true_pos, _ = np.histogram(self.conf[self.positive & self.hit], bins=edges)
+        false_pos, _ = np.histogram(self.conf[self.positive & ~self.hit], bins=edges)
+
         out = open(output, "w+")
         out.write("conf,rolling precision\n")
-        x = delta / 2
-        while x < 1.00 + (delta / 2):
-            true_pos = len(
-                [
-                    d
-                    for d in self.data["true_pos"]
-                    if x + (delta / 2) > d["conf"] >= x - (delta / 2)
-                ]
-            )
-            false_pos = len(
-                [
-                    d
-                    for d in self.data["false_pos"]
-                    if x + (delta / 2) > d["conf"] >= x - (delta / 2)
-                ]
-            )
-
-            if true_pos + false_pos != 0:
-                precision = true_pos / (true_pos + false_pos)
-                out.write(f"{x},{precision},{true_pos+false_pos}\n")
-
-            x += delta
+        for x, tp, fp in zip(edges[:-1] + delta / 2, true_pos, false_pos):
+            if tp + fp != 0:
+                out.write(f"{round(x, 6)},{tp / (tp + fp)},{tp + fp}\n")
         out.close()
@@ -0,0 +1,340 @@
+"""
+Timing benchmarks for the performance-sensitive parts of the pipeline and analysis tool.
+
+These run on synthetic data and do not require a trained model or dataset:
+
+    python3 -m analysis.timing load [--files <number of files>] [--rows <rows per file>]
+    python3 -m analysis.timing ckpt [--epochs <number of checkpoints>] [--model <model config>]
+    python3 -m analysis.timing metrics [--steps <training steps>] [--model <model config>]
+    python3 -m analysis.timing decode [--imgs <number of images>] [--width <frame width>]
+    python3 -m analysis.timing gate [--imgs <number of images>] [--threshold <threshold>]
+
+The metrics benchmark trains on random images, and needs a GPU.
+"""
+
+import os
+import glob
+import time
+import random
+import argparse
+import tempfile
+
+import torch
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import analysis.results as rload
+from analysis.benchmark import get_checkpoint_epochs, save_results
+from retrain import checkpoints, gating
+from retrain.dataloader import decode_image
+from yolov3 import metrics as yolometrics
+from yolov3.models import Darknet
+from yolov3.utils import parse_model_config, get_device, pad_to_square, resize
+
+
+def make_benchmark_df(num_rows, classes, num_files, rand):
+    """Create a dataframe resembling the output of benchmark_avg()."""
+    rows = list()
+    for i in range(num_rows):
+        actual = rand.choice(classes + [""])
+        detected = rand.choice(classes) if actual == "" else rand.choice(classes + [""])
+        rows.append(
+            {
+                "file": f"data/sample/images/frame{i % num_files:06d}.jpg",
+                "actual": actual,
+                "detected": detected,
+                "conf": 0.0 if detected == "" else rand.random(),
+                "conf_std": 0.0 if detected == "" else rand.random() / 4,
+                "hit": actual == detected,
+            }
+        )
+    return pd.DataFrame(rows, columns=rload.COLUMNS).sort_values(by="file")
+
+
+def time_load(num_files, num_rows):
+    """Compare the time to load benchmark files stored as CSV and as columnar .npz files."""
+    rand = random.Random("sage")
+    classes = ["car", "bus", "truck", "motorcycle", "van"]
+    df = make_benchmark_df(num_rows, classes, int(num_rows * 0.8), rand)
+
+    with tempfile.TemporaryDirectory() as folder:
+        for ext in (".csv", ".npz"):
+            files = [f"{folder}/bench{i}{ext}" for i in range(num_files)]
+            for filename in files:
+                save_results(df, filename)
+            size = sum(os.path.getsize(filename) for filename in files)
+
+            start = time.perf_counter()
+            for filename in files:
+                rload.load_data(filename, by_actual=False)
+            elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for filename in files:
+                rload.read_columns(filename, ["conf"])
+            projected = time.perf_counter() - start
+
+            print(
+                f"{ext}: {num_files} files, {size / 2 ** 20:.1f} MiB, "
+                f"load_data {elapsed:.2f}s ({1000 * elapsed / num_files:.1f} ms/file), "
+                f"conf column only {projected:.2f}s"
+            )
+
+
+def time_ckpt(num_epochs, model_def):
+    """Compare the disk use and load time of checkpoints stored in each format, with
+    weights that drift slightly between epochs as in retraining.
+
+    Checkpoints are loaded both in order and spaced apart, as averaged by benchmarks,
+    since spaced delta checkpoints are decoded along more of their chain."""
+    torch.manual_seed(0)
+    state_dict = Darknet(parse_model_config(model_def)).state_dict()
+    epochs = list()
+    for _ in range(num_epochs):
+        state_dict = {
+            key: tensor + 1e-4 * torch.randn_like(tensor)
+            if tensor.is_floating_point()
+            else tensor
+            for key, tensor in state_dict.items()
+        }
+        epochs.append(state_dict)
+
+    for ckpt_format in checkpoints.CKPT_FORMATS:
+        with tempfile.TemporaryDirectory() as folder:
+            store = checkpoints.CheckpointStore(folder, ckpt_format)
+            start = time.perf_counter()
+            paths = [
+                store.save(epoch_dict, "init", epoch)
+                for epoch, epoch_dict in enumerate(epochs, 1)
+            ]
+            saved = time.perf_counter() - start
+            size = sum(os.path.getsize(path) for path in paths)
+
+            # Decoded checkpoints are cached, so only the first load of each is timed
+            checkpoints._decoded.clear()
+            start = time.perf_counter()
+            loaded = [checkpoints.load_state_dict(path, "cpu") for path in paths]
+            elapsed = time.perf_counter() - start
+
+            spaced = get_checkpoint_epochs(1, num_epochs, max(2, num_epochs // 4))
+            checkpoints._decoded.clear()
+            start = time.perf_counter()
+            for epoch in spaced:
+                checkpoints.load_state_dict(paths[epoch - 1], "cpu")
+            spaced_elapsed = time.perf_counter() - start
+
+            error = max(
+                (loaded_dict[key].float() - tensor.float()).abs().max().item()
+                for epoch_dict, loaded_dict in zip(epochs, loaded)
+                for key, tensor in epoch_dict.items()
+            )
+            print(
+                f"{ckpt_format}: {num_epochs} checkpoints, {size / 2 ** 20:.1f} MiB, "
+                f"save {saved:.2f}s, load {elapsed:.2f}s "
+                f"({1000 * elapsed / num_epochs:.1f} ms/checkpoint), "
+                f"{len(spaced)} spaced apart "
+                f"{1000 * spaced_elapsed / len(spaced):.1f} ms/checkpoint, "
+                f"max error {error:.2e}"
+            )
+
+
+def time_metrics(num_steps, model_def, batch_size=8, img_size=416, log_interval=10):
+    """Compare training steps per second when YOLO layer metrics are copied from the
+    GPU and tabulated after every batch, and when they are accumulated on the GPU and
+    summarized at the log interval. Tables are rendered but not printed."""
+    device = get_device()
+    if device.type != "cuda":
+        print("The metrics benchmark needs a GPU")
+        return
+
+    torch.manual_seed(0)
+    model = Darknet(parse_model_config(model_def), img_size).to(device)
+    model.device = device
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters())
+    metrics = ["grid_size", "loss", "x", "y", "w", "h", "conf", "cls", "cls_acc"]
+    metrics += ["recall50", "recall75", "precision", "conf_obj", "conf_noobj"]
+
+    imgs = torch.rand(batch_size, 3, img_size, img_size, device=device)
+    targets = torch.rand(batch_size * 4, 6, device=device) * 0.5 + 0.25
+    targets[:, 0] = torch.arange(batch_size * 4, device=device) % batch_size
+    targets[:, 1] = 0
+
+    def step():
+        loss, _ = model(imgs, targets)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        return loss
+
+    for accumulate in (False, True):
+        tracker = yolometrics.MetricsTracker(model, metrics)
+        for _ in range(3):
+            step()
+        torch.cuda.synchronize(device)
+
+        start = time.perf_counter()
+        for step_i in range(num_steps):
+            loss = step()
+            if accumulate:
+                tracker.update(loss)
+                if step_i % log_interval == 0:
+                    yolometrics.format_table(tracker.summarize()[1], metrics)
+            else:
+                layers = [
+                    {
+                        name: value.item() if torch.is_tensor(value) else value
+                        for name, value in yolo.metrics.items()
+                    }
+                    for yolo in model.yolo_layers
+                ]
+                yolometrics.format_table(layers, metrics)
+                loss.item()
+        torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start
+
+        mode = "accumulated" if accumulate else "per batch"
+        print(f"{mode}: {num_steps} steps, {num_steps / elapsed:.2f} steps/s")
+
+
+def time_decode(num_imgs, width, img_size=416):
+    """Compare the throughput of loading camera frames into a benchmark ImageFolder with
+    full resolution decoding and with reduced scale JPEG decoding."""
+    rand = np.random.default_rng(0)
+    height = width * 9 // 16
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(f"{folder}/images")
+        for i in range(num_imgs):
+            # Smooth noise compresses more like a camera frame than white noise
+            noise = rand.integers(
+                0, 256, (height // 16, width // 16, 3), dtype=np.uint8
+            )
+            frame = Image.fromarray(noise).resize((width, height), Image.BILINEAR)
+            frame.save(f"{folder}/images/frame{i:04d}.jpg", quality=90)
+
+        imgs = sorted(glob.glob(f"{folder}/images/*.jpg"))
+        loaded = dict()
+        for draft in (False, True):
+            start = time.perf_counter()
+            loaded[draft] = list()
+            for img_path in imgs:
+                # Same steps as ImageFolder.load_img()
+                img = decode_image(img_path, img_size if draft else None)
+                img = torch.from_numpy(np.array(img)).permute(2, 0, 1).contiguous()
+                img, _ = pad_to_square(img, 0)
+                loaded[draft].append(resize(img, img_size))
+            elapsed = time.perf_counter() - start
+
+            mode = "draft" if draft else "full"
+            print(
+                f"{mode}: {num_imgs} {width}x{height} frames, "
+                f"{num_imgs / elapsed:.1f} frames/s"
+            )
+
+        diff = [
+            (full.float() - draft.float()).abs().mean().item()
+            for full, draft in zip(loaded[False], loaded[True])
+        ]
+        print(f"Mean absolute pixel difference: {np.mean(diff):.2f}")
+
+
+def make_static_camera(folder, num_imgs, width=1280, change_every=10, seed=0):
+    """Save the frames of a simulated static camera to a folder, where the scene changes
+    every few frames and frames differ by sensor noise otherwise. Scenes hold a vehicle
+    of one of three classes, or none.
+
+    Returns a dictionary of frame paths and the detections of the vehicle in each frame,
+    standing in for full inference.
+    """
+    rand = np.random.default_rng(seed)
+    height = width * 9 // 16
+    colors = [(200, 30, 30), (30, 200, 30), (30, 30, 200)]
+
+    background = rand.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+    background = np.array(
+        Image.fromarray(background).resize((width, height), Image.BILINEAR)
+    )
+    detections = dict()
+    for i in range(num_imgs):
+        if i % change_every == 0:
+            # A vehicle enters a new part of the frame, except in every fourth scene
+            scene = background.copy()
+            vehicle = None
+            if (i // change_every) % 4 != 3:
+                x = rand.integers(0, width * 3 // 4)
+                y = rand.integers(0, height * 3 // 4)
+                w, h, cls = width // 4, height // 4, rand.integers(0, len(colors))
+                scene[y : y + h, x : x + w] = colors[cls]
+                vehicle = torch.tensor([[[x, y, x + w, y + h, 1.0, 1.0, cls]]]).float()
+        noise = rand.normal(0, 2, scene.shape)
+        frame = np.clip(scene + noise, 0, 255).astype(np.uint8)
+        path = f"{folder}/frame{i:04d}.jpg"
+        Image.fromarray(frame).save(path, quality=90)
+        detections[path] = vehicle
+    return detections
+
+
+def time_gate(num_imgs, threshold, change_every=10):
+    """Measure the inference skipped by frame-difference gating on a simulated static
+    camera, and how often the reused detections agree with full inference."""
+    with tempfile.TemporaryDirectory() as folder:
+        detections = make_static_camera(folder, num_imgs, change_every=change_every)
+        start = time.perf_counter()
+        plan = gating.plan_inference(detections.keys(), threshold)
+        elapsed = time.perf_counter() - start
+
+    inferred = len(gating.get_inferred(plan))
+    print(
+        f"Inferred on {inferred} of {num_imgs} frames "
+        f"({1 - inferred / num_imgs:.0%} skipped, {num_imgs // change_every} scenes)"
+    )
+    agreement = gating.get_agreement(plan, detections)
+    if agreement is not None:
+        print(
+            f"Detections of skipped frames agree with full inference: {agreement:.1%}"
+        )
+    print(f"Gating: {elapsed / num_imgs * 1000:.2f} ms/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time parts of the pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load = subparsers.add_parser("load", help="benchmark file loading")
+    load.add_argument("--files", type=int, default=300)
+    load.add_argument("--rows", type=int, default=3000)
+
+    ckpt = subparsers.add_parser("ckpt", help="benchmark checkpoint formats")
+    ckpt.add_argument("--epochs", type=int, default=20)
+    ckpt.add_argument("--model", default="config/cars-yolov3.cfg")
+
+    metrics = subparsers.add_parser("metrics", help="benchmark training metrics")
+    metrics.add_argument("--steps", type=int, default=100)
+    metrics.add_argument("--model", default="config/cars-yolov3.cfg")
+
+    decode = subparsers.add_parser("decode", help="benchmark image decoding")
+    decode.add_argument("--imgs", type=int, default=100)
+    decode.add_argument("--width", type=int, default=1920)
+
+    gate = subparsers.add_parser("gate", help="benchmark inference gating")
+    gate.add_argument("--imgs", type=int, default=200)
+    gate.add_argument("--threshold", type=float, default=0.02)
+
+    opt = parser.parse_args()
+
+    if opt.command == "load":
+        time_load(opt.files, opt.rows)
+    elif opt.command == "ckpt":
+        time_ckpt(opt.epochs, opt.model)
+    elif opt.command == "metrics":
+        time_metrics(opt.steps, opt.model)
+    elif opt.command == "decode":
+        time_decode(opt.imgs, opt.width)
+    elif opt.command == "gate":
+        time_gate(opt.imgs, opt.threshold)
+
+
+if __name__ == "__main__":
+    main()
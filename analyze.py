@@ -10,8 +10,9 @@ import argparse
 from userdefs import get_sample_methods
 from yolov3 import parallelize
 
-from retrain import utils
+from retrain import utils, stream
 import analysis.benchmark as bench
+import analysis.results as rload
 from analysis import charts
 
 
@@ -36,6 +37,7 @@ def get_args(prefixes):
     parser.add_argument("--benchmark", action="store_true", default=False)
     parser.add_argument("--visualize_conf", default=None)
     parser.add_argument("--view_benchmark", default=None)
+    parser.add_argument("--reservoir", type=int, default=None)
 
     parser.add_argument("--filter_sample", action="store_true", default=False)
     parser.add_argument("--compare_init", action="store_true", default=False)
@@ -54,6 +56,8 @@ def get_args(prefixes):
     parser.add_argument("--metric2", choices=metric_names, default=None)
 
     opt = parser.parse_args()
+    if opt.reservoir is not None and opt.prefix in (None, "init"):
+        parser.error("--reservoir requires the --prefix of a sampling method")
     config = utils.parse_retrain_config(opt.config)
     return opt, config
 
@@ -81,8 +85,8 @@ def benchmark_batch_test(prefixes, config, opt, num_batches):
         parallelize.run_parallel(bench.benchmark_batch_test_set, batch_args)
 
 
-def get_benchmark_suffix(opt):
-    bench_suffix = "_*.csv"
+def get_benchmark_suffix(opt, config):
+    bench_suffix = "_*" + rload.get_bench_ext(config)
     if opt.batch_test is not None:
         # Default is rolling average on batch test set
         bench_suffix = "_test" + bench_suffix
@@ -102,7 +106,7 @@ def main():
     prefixes = ["init"] + list(get_sample_methods().keys())
 
     opt, config = get_args(prefixes)
-    bench_suffix = get_benchmark_suffix(opt)
+    bench_suffix = get_benchmark_suffix(opt, config)
 
     if opt.benchmark:
         if opt.prefix is not None:
@@ -144,6 +148,10 @@ def main():
         )
     elif opt.view_benchmark is not None:
         charts.display_benchmark(opt.view_benchmark, config)
+    elif opt.reservoir is not None:
+        # Replay a batch split through per-class reservoirs weighted by the method's curve
+        sample_method = (opt.prefix, get_sample_methods()[opt.prefix])
+        stream.reservoir_batch(sample_method, config, opt.reservoir)
 
     elif opt.prefix is not None:
         charts.tabulate_batch_samples(config, opt.prefix, bench_suffix=bench_suffix)
@@ -0,0 +1,398 @@
+"""
+Storage and index of the checkpoints in a checkpoint folder.
+
+Checkpoints are named <sampling method><batch number>_ckpt_<epoch>.pth, or
+init_ckpt_<epoch>.pth for initial training. Lookups by prefix match the same files as the
+glob pattern <prefix>*_ckpt_<epoch>.pth.
+
+Checkpoints are written to a temporary file and renamed into place, so a checkpoint that
+exists is always complete. They may be stored in one of the following formats, decoded by load_state_dict():
+    full   the float32 state dictionary, as written by torch.save()
+    fp16   floating point weights in half precision
+    delta  differences from the previous checkpoint of the same prefix, quantized to int8
+           with a scale per tensor, and a half precision keyframe every few checkpoints.
+           Each delta records the content hash of its base checkpoint, so a delta whose
+           base was changed or replaced fails to load instead of decoding wrongly
+"""
+
+import os
+import re
+import inspect
+import queue
+import threading
+from collections import OrderedDict
+
+import torch
+
+from retrain.manifest import hash_file
+
+CKPT_PATTERN = re.compile(r"^(?P<stem>.+)_ckpt_(?P<epoch>\d+)\.pth$")
+CKPT_FORMATS = ("full", "fp16", "delta")
+FORMAT_KEY = "ckpt_format"
+# torch.load() memory-maps checkpoints from PyTorch 2.1 onwards
+MMAP_SUPPORTED = "mmap" in inspect.signature(torch.load).parameters
+
+_registries = dict()
+_decoded = OrderedDict()
+_digests = dict()
+
+
+def get_registry(folder):
+    """Get the checkpoint registry of a folder, scanning it once per process."""
+    key = os.path.realpath(folder)
+    if key not in _registries.keys():
+        _registries[key] = CheckpointRegistry(folder)
+    return _registries[key]
+
+
+class CheckpointRegistry:
+    """Maps the stem (prefix and batch number) and epoch of each checkpoint to its path.
+
+    The folder is listed once, and again only when a lookup misses or lists epochs after
+    the folder has changed, such as when another process saves a checkpoint.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.ckpts = dict()
+        self.scan_time = None
+        self.scan()
+
+    def scan(self):
+        ckpts = dict()
+        if os.path.isdir(self.folder):
+            self.scan_time = os.stat(self.folder).st_mtime_ns
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    add_ckpt(ckpts, f"{self.folder}/{entry.name}")
+        # Replaced at once, since the checkpoint writer thread may look up checkpoints
+        self.ckpts = ckpts
+
+    def refresh(self):
+        """Rescan the folder if files were added or removed since the last scan."""
+        if not os.path.isdir(self.folder):
+            return False
+        if os.stat(self.folder).st_mtime_ns != self.scan_time:
+            self.scan()
+            return True
+        return False
+
+    def add(self, path):
+        """Add a checkpoint, such as one that was just saved. Other files are ignored."""
+        add_ckpt(self.ckpts, path)
+
+    def get_stems(self, prefix, batch=None):
+        if batch is not None:
+            stem = f"{prefix}{batch}"
+            return [stem] if stem in self.ckpts.keys() else list()
+        return sorted(stem for stem in self.ckpts.keys() if stem.startswith(prefix))
+
+    def find(self, prefix, epoch, batch=None):
+        """Get the path of a checkpoint of the given prefix (and batch number, if given)
+        at an epoch, or None if there is none."""
+        for attempt in range(2):
+            for stem in self.get_stems(prefix, batch):
+                if epoch in self.ckpts[stem].keys():
+                    return self.ckpts[stem][epoch]
+            if attempt == 0 and not self.refresh():
+                break
+        return None
+
+    def get_range(self, prefix, start=None, end=None, batch=None):
+        """Get a dictionary of epochs and checkpoint paths of a prefix within an inclusive
+        range of epochs, sorted by epoch."""
+        self.refresh()
+        ckpts = dict()
+        for stem in reversed(self.get_stems(prefix, batch)):
+            for epoch, path in self.ckpts[stem].items():
+                if (start is None or epoch >= start) and (end is None or epoch <= end):
+                    ckpts[epoch] = path
+        return dict(sorted(ckpts.items()))
+
+    def get_epochs(self, prefix, batch=None):
+        """Get a sorted list of epochs with checkpoints for a prefix."""
+        return list(self.get_range(prefix, batch=batch).keys())
+
+
+def add_ckpt(ckpts, path):
+    match = CKPT_PATTERN.match(os.path.basename(path))
+    if match is not None:
+        epochs = ckpts.setdefault(match.group("stem"), dict())
+        epochs[int(match.group("epoch"))] = path
+
+
+def get_store(config):
+    """Get a checkpoint store with the format set in the configuration, or full
+    precision checkpoints by default."""
+    ckpt_format = config["ckpt_format"] if "ckpt_format" in config.keys() else "full"
+    keyframe = config["ckpt_keyframe"] if "ckpt_keyframe" in config.keys() else 10
+    return CheckpointStore(config["checkpoints"], ckpt_format, int(keyframe))
+
+
+class CheckpointStore:
+    """Saves the checkpoints of a training run in one of the CKPT_FORMATS.
+
+    Arguments
+        folder             checkpoint folder
+        ckpt_format        storage format of the checkpoints
+        keyframe_interval  maximum number of delta checkpoints between full precision ones
+    """
+
+    def __init__(self, folder, ckpt_format="full", keyframe_interval=10):
+        if ckpt_format not in CKPT_FORMATS:
+            raise ValueError(f"Checkpoint format must be one of {CKPT_FORMATS}")
+        self.folder = folder
+        self.format = ckpt_format
+        self.keyframe_interval = keyframe_interval
+
+    def save(self, state_dict, prefix, epoch, path=None):
+        """Save a state dictionary as the checkpoint of a prefix at an epoch."""
+        if path is None:
+            path = f"{self.folder}/{prefix}_ckpt_{epoch}.pth"
+
+        if self.format == "full":
+            ckpt = state_dict
+        elif self.format == "fp16":
+            ckpt = {FORMAT_KEY: "fp16", "state_dict": to_half(state_dict)}
+        else:
+            ckpt = self.encode_delta(state_dict, prefix, epoch)
+
+        # The temporary name does not match CKPT_PATTERN, so it is never looked up
+        tmp_path = f"{path}.tmp"
+        torch.save(ckpt, tmp_path)
+        os.replace(tmp_path, path)
+
+        get_registry(self.folder).add(path)
+        return path
+
+    def encode_delta(self, state_dict, prefix, epoch):
+        state_dict = {key: tensor.detach().cpu() for key, tensor in state_dict.items()}
+
+        base = get_registry(self.folder).get_range(prefix, end=epoch - 1, batch="")
+        base = list(base.values())[-1] if len(base) != 0 else None
+        chain = 0
+        if base is not None:
+            base_ckpt = load_mmap(base, "cpu")
+            chain = base_ckpt.get("chain", 0) + 1 if FORMAT_KEY in base_ckpt else 1
+
+        if base is None or chain > self.keyframe_interval:
+            return {
+                FORMAT_KEY: "delta",
+                "base": None,
+                "chain": 0,
+                "state_dict": to_half(state_dict),
+            }
+
+        # Differences are taken from the decoded base, so quantization errors do not
+        # build up along the chain
+        base_state = load_state_dict(base)
+        delta, scales = dict(), dict()
+        for key, tensor in state_dict.items():
+            if not tensor.is_floating_point():
+                delta[key] = tensor
+                continue
+            diff = tensor.float() - base_state[key]
+            scale = diff.abs().max().item() / 127
+            scales[key] = scale if scale > 0 else 1.0
+            delta[key] = torch.round(diff / scales[key]).to(torch.int8)
+        return {
+            FORMAT_KEY: "delta",
+            "base": os.path.basename(base),
+            "base_digest": get_digest(base),
+            "chain": chain,
+            "state_dict": delta,
+            "scales": scales,
+        }
+
+
+class CheckpointWriter:
+    """Saves checkpoints with a CheckpointStore on a background thread, so that training
+    continues while they are serialized.
+
+    State dictionaries are copied to (pinned, if using CUDA) CPU memory when submitted,
+    and copy buffers are reused between checkpoints. Once the given number of
+    checkpoints are waiting to be written, submit() blocks until one is done.
+
+    Arguments
+        store        CheckpointStore to save with
+        run          run manifest to record saved checkpoints in
+        max_pending  maximum number of checkpoints waiting to be written
+    """
+
+    def __init__(self, store, run=None, max_pending=2):
+        self.store = store
+        self.run = run
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.buffers = list()
+        self.error = None
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def submit(self, state_dict, prefix, epoch):
+        """Copy a state dictionary and queue it to be saved as the checkpoint of a
+        prefix at an epoch."""
+        self.check()
+        snapshot, copied = self.snapshot(state_dict)
+        self.queue.put((snapshot, copied, prefix, epoch))
+
+    def snapshot(self, state_dict):
+        buffers = self.buffers.pop() if len(self.buffers) != 0 else None
+        if buffers is None or any(
+            key not in buffers.keys() or buffers[key].shape != tensor.shape
+            for key, tensor in state_dict.items()
+        ):
+            buffers = {
+                key: torch.empty(
+                    tensor.shape,
+                    dtype=tensor.dtype,
+                    pin_memory=torch.cuda.is_available(),
+                )
+                for key, tensor in state_dict.items()
+            }
+
+        for key, tensor in state_dict.items():
+            buffers[key].copy_(tensor.detach(), non_blocking=True)
+
+        # Copies from the GPU finish asynchronously, so the writer waits on an event
+        copied = None
+        if any(tensor.is_cuda for tensor in state_dict.values()):
+            copied = torch.cuda.Event()
+            copied.record()
+        return buffers, copied
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            snapshot, copied, prefix, epoch = item
+            try:
+                if copied is not None:
+                    copied.synchronize()
+                path = self.store.save(snapshot, prefix, epoch)
+                if self.run is not None:
+                    self.run.record("checkpoint", path, [path])
+                self.buffers.append(snapshot)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Checkpoint could not be saved") from error
+
+    def flush(self):
+        """Wait until all submitted checkpoints are written."""
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """Flush the checkpoints and stop the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+
+def to_half(state_dict):
+    return {
+        key: tensor.detach().cpu().half() if tensor.is_floating_point() else tensor
+        for key, tensor in state_dict.items()
+    }
+
+
+def load_state_dict(path, map_location=None, cache_size=4):
+    """Load the state dictionary of a checkpoint in any of the CKPT_FORMATS.
+
+    Checkpoints are memory-mapped if PyTorch supports it, so tensors are only read from
+    disk when used. Half precision and delta checkpoints are decoded on the CPU.
+
+    A delta checkpoint is decoded by applying each delta from its nearest keyframe (or
+    nearest decoded checkpoint still cached) onwards, so loading a checkpoint that is
+    not a neighbour of the last one reads up to ckpt_keyframe deltas. The most recently
+    decoded checkpoints and the keyframes they were decoded from are cached, and each
+    call returns a new dictionary of the cached tensors.
+    """
+    target = get_cache_key(path)
+    links = list()
+    while True:
+        key = get_cache_key(path)
+        if key in _decoded.keys():
+            _decoded.move_to_end(key)
+            state_dict = _decoded[key]
+            break
+
+        ckpt = load_mmap(path, map_location)
+        if FORMAT_KEY not in ckpt.keys():
+            # Full precision checkpoints are already memory-mapped, so are not cached
+            state_dict = ckpt
+            break
+        if ckpt[FORMAT_KEY] == "fp16" or ckpt["base"] is None:
+            state_dict = cache_decoded(key, to_float(ckpt["state_dict"]), cache_size)
+            break
+
+        links.append(ckpt)
+        base = f"{os.path.dirname(path)}/{ckpt['base']}"
+        if not os.path.exists(base):
+            raise RuntimeError(f"Base checkpoint {base} of {path} does not exist")
+        if "base_digest" in ckpt.keys() and get_digest(base) != ckpt["base_digest"]:
+            raise RuntimeError(f"Base checkpoint {base} of {path} has changed")
+        path = base
+
+    for ckpt in reversed(links):
+        state_dict = apply_delta(state_dict, ckpt)
+    if len(links) != 0:
+        state_dict = cache_decoded(target, state_dict, cache_size)
+    return dict(state_dict)
+
+
+def get_cache_key(path):
+    return (os.path.realpath(path), os.path.getmtime(path))
+
+
+def cache_decoded(key, state_dict, cache_size):
+    _decoded[key] = state_dict
+    while len(_decoded) > cache_size:
+        _decoded.popitem(last=False)
+    return state_dict
+
+
+def apply_delta(base, ckpt):
+    """Add the differences of a delta checkpoint to its decoded base."""
+    # Deltas saved before quantization was added hold half precision differences
+    scales = ckpt.get("scales", dict())
+    return {
+        name: base[name] + tensor.cpu().float() * scales.get(name, 1.0)
+        if name in scales.keys() or tensor.is_floating_point()
+        else tensor.cpu()
+        for name, tensor in ckpt["state_dict"].items()
+    }
+
+
+def to_float(state_dict):
+    return {
+        name: tensor.cpu().float() if tensor.is_floating_point() else tensor.cpu()
+        for name, tensor in state_dict.items()
+    }
+
+
+def get_digest(path):
+    """Get the content hash of a checkpoint, hashing it again only if its size or
+    modification time changed."""
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _digests.keys():
+        _digests[key] = hash_file(path)
+    return _digests[key]
+
+
+def load_mmap(path, map_location=None):
+    if not MMAP_SUPPORTED:
+        return torch.load(path, map_location=map_location)
+    try:
+        return torch.load(path, map_location=map_location, mmap=True)
+    except RuntimeError:
+        # Checkpoints saved in the legacy format cannot be memory-mapped
+        return torch.load(path, map_location=map_location)
@@ -20,13 +20,15 @@ from torchvision.transforms import transforms
 from retrain import sampling
 from retrain.augment import Augmenter
 from retrain.utils import get_label_path, get_lines
-from yolov3.utils import pad_to_square, resize
+from yolov3 import shared
+from yolov3.utils import get_padding, pad_to_square, resize
 
 
 class ImageFolder(Dataset):
     """Dataset representation of a (potentially unlabeled) set of images.
 
-    Iterable provides an image path and an image tensor of the specified size.
+    Iterable provides an image path and a uint8 image tensor of the specified size, which
+    is converted to floats by the consumer, such as evaluate.detect().
     """
 
     def __init__(self, src, img_size, prefix=str()):
@@ -52,17 +54,33 @@ class ImageFolder(Dataset):
 
         self.prefix = prefix
         self.img_size = img_size
+        self.img_cache = dict()
 
     def __getitem__(self, index):
         img_path = list(self.imgs)[index % len(self.imgs)]
+        if img_path in self.img_cache.keys():
+            img = self.img_cache[img_path]
+        else:
+            img = self.load_img(img_path)
+
+        return img_path, img
+
+    def load_img(self, img_path):
+        """Load an image as a square uint8 tensor of the folder's resolution."""
         # Extract image as PyTorch tensor
-        img = transforms.ToTensor()(Image.open(img_path).convert("RGB"))
+        img = torch.from_numpy(np.array(decode_image(img_path, self.img_size)))
+        img = img.permute(2, 0, 1).contiguous()
         # Pad to square resolution
         img, _ = pad_to_square(img, 0)
         # Resize
-        img = resize(img, self.img_size)
+        return resize(img, self.img_size)
 
-        return img_path, img
+    def cache_imgs(self):
+        """Decode all images in the folder once and keep them in memory as uint8 tensors,
+        which are reused each time the folder is iterated over."""
+        for img_path in self.imgs:
+            if img_path not in self.img_cache.keys():
+                self.img_cache[img_path] = self.load_img(img_path)
 
     def __len__(self):
         return len(self.imgs)
@@ -145,12 +163,61 @@ def get_images(path):
     return imgs
 
 
+def decode_image(img_path, min_size=None):
+    """Decode an image in RGB.
+
+    If a minimum size is given, JPEGs larger than it are decoded at a reduced scale
+    (1/2, 1/4, or 1/8) in the DCT domain, as long as their longer side is still at least
+    the minimum size. Since images are padded and resized to a square, this is enough
+    to resize them to that size, and the aspect ratio and normalized label coordinates
+    are kept.
+    """
+    img = Image.open(img_path)
+    if min_size is not None and img.format == "JPEG":
+        w, h = img.size
+        scale = min_size / max(w, h)
+        if scale < 1:
+            img.draft("RGB", (math.ceil(w * scale), math.ceil(h * scale)))
+    return img.convert("RGB")
+
+
+def pad_targets(labels, h, w, normalized=True):
+    """Convert the Darknet labels of an image into targets for the image after it is
+    padded to a square, with an empty first column for the sample index."""
+    boxes = torch.from_numpy(np.asarray(labels, dtype=np.float64).reshape(-1, 5))
+    h_factor, w_factor = (h, w) if normalized else (1, 1)
+
+    pad = get_padding(h, w)
+    padded_h, padded_w = h + pad[2] + pad[3], w + pad[0] + pad[1]
+
+    # Extract coordinates for unpadded + unscaled image
+    x1 = w_factor * (boxes[:, 1] - boxes[:, 3] / 2)
+    y1 = h_factor * (boxes[:, 2] - boxes[:, 4] / 2)
+    x2 = w_factor * (boxes[:, 1] + boxes[:, 3] / 2)
+    y2 = h_factor * (boxes[:, 2] + boxes[:, 4] / 2)
+    # Adjust for added padding
+    x1 += pad[0]
+    y1 += pad[2]
+    x2 += pad[1]
+    y2 += pad[3]
+    # Returns (x, y, w, h)
+    boxes[:, 1] = ((x1 + x2) / 2) / padded_w
+    boxes[:, 2] = ((y1 + y2) / 2) / padded_h
+    boxes[:, 3] *= w_factor / padded_w
+    boxes[:, 4] *= h_factor / padded_h
+
+    targets = torch.zeros((len(boxes), 6))
+    targets[:, 1:] = boxes
+    return targets
+
+
 class LabeledSet(ImageFolder):
     """A Dataset object inheriting from ImageFolder containing labeled images only."""
 
     def __init__(self, src, num_classes, img_size=416, prefix=str(), **args):
         super().__init__(src, img_size, prefix, **args)
         self.num_classes = num_classes
+        self.label_index = dict()
 
         self.filter_images()
         self.labels = self.get_labels()
@@ -176,6 +243,31 @@ class LabeledSet(ImageFolder):
         """Get a set of labels corresponding to images in the folder."""
         return {get_label_path(img) for img in self.imgs}
 
+    def get_label_index(self, imgs=None):
+        """Get a dictionary of image paths and their labels as target tensors for the
+        padded image. Label files are read once and kept in the folder's label index.
+
+        Image sizes are read from file headers without decoding the images.
+        """
+        if imgs is None:
+            imgs = self.imgs
+        for img in imgs:
+            if img in self.label_index.keys():
+                continue
+            targets = shared.get_labels(img)
+            if targets is not None:
+                self.label_index[img] = targets
+                continue
+            labels = [
+                list(map(float, lab.split()))
+                for lab in get_lines(get_label_path(img))
+                if lab != ""
+            ]
+            with Image.open(img) as img_file:
+                w, h = img_file.size
+            self.label_index[img] = pad_targets(labels, h, w)
+        return {img: self.label_index[img] for img in imgs}
+
     def make_img_dict(self):
         """Get a dictionary of image paths and their corresponding classes."""
         img_dict = dict()
@@ -355,7 +447,9 @@ class ListDataset(Dataset):
         while img is None and i < len(self.img_files):
             try:
                 img_path = self.img_files[(index + i) % len(self.img_files)].rstrip()
-                img = transforms.ToTensor()(Image.open(img_path).convert("RGB"))
+                # Labels in pixels are relative to the full resolution image
+                min_size = self.max_size if self.normalized_labels else None
+                img = transforms.ToTensor()(decode_image(img_path, min_size))
             except OSError:
                 if os.path.exists(img_path):
                     os.remove(img_path)
@@ -367,35 +461,17 @@ class ListDataset(Dataset):
             img = img.expand((3, img.shape[1:]))
 
         _, h, w = img.shape
-        h_factor, w_factor = (h, w) if self.normalized_labels else (1, 1)
 
         # Pad to square resolution
-        img, pad = pad_to_square(img, 0)
-        _, padded_h, padded_w = img.shape
+        img, _ = pad_to_square(img, 0)
 
         label_path = self.label_files[index % len(self.img_files)].rstrip()
 
         targets = None
         if os.path.exists(label_path):
-            boxes = torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
-            # Extract coordinates for unpadded + unscaled image
-            x1 = w_factor * (boxes[:, 1] - boxes[:, 3] / 2)
-            y1 = h_factor * (boxes[:, 2] - boxes[:, 4] / 2)
-            x2 = w_factor * (boxes[:, 1] + boxes[:, 3] / 2)
-            y2 = h_factor * (boxes[:, 2] + boxes[:, 4] / 2)
-            # Adjust for added padding
-            x1 += pad[0]
-            y1 += pad[2]
-            x2 += pad[1]
-            y2 += pad[3]
-            # Returns (x, y, w, h)
-            boxes[:, 1] = ((x1 + x2) / 2) / padded_w
-            boxes[:, 2] = ((y1 + y2) / 2) / padded_h
-            boxes[:, 3] *= w_factor / padded_w
-            boxes[:, 4] *= h_factor / padded_h
-
-            targets = torch.zeros((len(boxes), 6))
-            targets[:, 1:] = boxes
+            targets = pad_targets(
+                np.loadtxt(label_path), h, w, normalized=self.normalized_labels
+            )
 
         return img_path, img, targets
 
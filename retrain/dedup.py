@@ -0,0 +1,122 @@
+"""
+Suppression of near-duplicate frames in a sampling batch.
+
+Consecutive frames of a video feed are often nearly identical, so only one frame of
+each group of near-duplicates needs to be benchmarked and sampled. Frames are compared
+by their difference hashes (dHash), 64-bit fingerprints of the brightness gradients of
+a tiny grayscale copy, which differ in few bits for similar images.
+"""
+
+import os
+import json
+
+import numpy as np
+from PIL import Image
+
+from retrain.dataloader import decode_image
+
+HASH_SIZE = 8
+
+
+def get_thumbnails(img_paths, width, height):
+    """Get an array of tiny grayscale copies of images, with values from 0 to 255."""
+    # Decoding near the thumbnail size is enough, so JPEGs are decoded at reduced scale
+    return np.stack(
+        [
+            np.asarray(
+                decode_image(path, 4 * max(width, height))
+                .convert("L")
+                .resize((width, height), Image.BILINEAR),
+                dtype=np.int16,
+            )
+            for path in img_paths
+        ]
+    )
+
+
+def dhash(img_paths, hash_size=HASH_SIZE):
+    """Get an array with the difference hash of each image as an unsigned integer."""
+    thumbs = get_thumbnails(img_paths, hash_size + 1, hash_size)
+    bits = thumbs[:, :, 1:] > thumbs[:, :, :-1]
+    packed = np.packbits(bits.reshape(len(img_paths), -1), axis=1)
+    return packed.view(">u8").ravel().astype(np.uint64)
+
+
+def hamming(code, codes):
+    """Get the number of bits that differ between a hash and an array of hashes."""
+    diff = np.bitwise_xor(codes, np.uint64(code))
+    return np.unpackbits(diff.astype(">u8").view(np.uint8).reshape(-1, 8), axis=1).sum(
+        axis=1
+    )
+
+
+class HammingIndex:
+    """Index of 64-bit hashes for finding those within a Hamming distance of a query.
+
+    Hashes are split into one more band than the maximum distance, so any hash within
+    the distance matches the query exactly on at least one band. Only hashes sharing
+    a band are compared.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        num_bands = max_distance + 1
+        bounds = np.linspace(0, 64, num_bands + 1, dtype=int)
+        self.masks = [
+            np.uint64(((1 << int(end - start)) - 1) << int(start))
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        self.bands = [dict() for _ in self.masks]
+        self.codes = list()
+        self.items = list()
+
+    def add(self, code, item):
+        i = len(self.items)
+        self.codes.append(code)
+        self.items.append(item)
+        for mask, band in zip(self.masks, self.bands):
+            band.setdefault(int(code & mask), list()).append(i)
+
+    def query(self, code):
+        """Get the first added item within the maximum distance of a hash, or None."""
+        candidates = set()
+        for mask, band in zip(self.masks, self.bands):
+            candidates.update(band.get(int(code & mask), list()))
+        if len(candidates) == 0:
+            return None
+
+        candidates = sorted(candidates)
+        codes = np.array([self.codes[i] for i in candidates], dtype=np.uint64)
+        close = np.nonzero(hamming(code, codes) <= self.max_distance)[0]
+        return self.items[candidates[close[0]]] if len(close) != 0 else None
+
+
+def cluster_images(img_paths, max_distance):
+    """Group images with hashes within a Hamming distance of a representative image.
+
+    Images are taken in order of their paths, so consecutive frames join the cluster of
+    the earliest similar frame. Returns a dictionary of representative images and the
+    images in their cluster, including themselves.
+    """
+    img_paths = sorted(img_paths)
+    if len(img_paths) == 0:
+        return dict()
+
+    index = HammingIndex(max_distance)
+    clusters = dict()
+    for path, code in zip(img_paths, dhash(img_paths)):
+        representative = index.query(code)
+        if representative is None:
+            index.add(code, path)
+            clusters[path] = [path]
+        else:
+            clusters[representative].append(path)
+    return clusters
+
+
+def save_clusters(clusters, filename):
+    """Save the members of each cluster, to label them along with their representative."""
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "w+") as out:
+        json.dump(clusters, out, indent=1)
+    os.replace(tmp_filename, filename)
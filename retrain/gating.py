@@ -0,0 +1,95 @@
+"""
+Frame-difference gating of inference, simulating a static camera at the edge.
+
+Each frame is compared with the last frame that was inferred on, using small grayscale
+copies split into a grid of blocks. If the mean absolute difference of every block is
+within a threshold, the scene has not changed and the detections of the last inferred
+frame are reused instead of running the model again. Comparing blocks rather than whole
+frames keeps a small object entering the scene from being averaged away.
+"""
+
+import numpy as np
+
+from retrain import dedup
+from yolov3 import utils as yoloutils
+
+THUMB_SIZE = 32
+GRID_SIZE = 8
+
+
+def get_gate_threshold(config):
+    """Get the frame difference threshold set in the configuration, or None if gating
+    is disabled."""
+    if "gate_threshold" in config.keys() and config["gate_threshold"] > 0:
+        return config["gate_threshold"]
+    return None
+
+
+def plan_inference(img_paths, threshold, thumb_size=THUMB_SIZE):
+    """Decide which frames to infer on, taking frames in order of their paths.
+
+    Arguments
+        img_paths   image paths of the frames
+        threshold   mean absolute difference of a block from the last inferred frame, as a
+                    fraction of the brightness range, under which a frame is skipped
+        thumb_size  width and height of the copies that frames are compared with
+
+    Returns a dictionary of each frame and the frame whose detections it uses, which
+    is itself for frames that are inferred on.
+    """
+    img_paths = sorted(img_paths)
+    if len(img_paths) == 0:
+        return dict()
+
+    thumbs = dedup.get_thumbnails(img_paths, thumb_size, thumb_size)
+    block = thumb_size // GRID_SIZE
+    plan = dict()
+    reference = 0
+    for i, path in enumerate(img_paths):
+        diff = np.abs(thumbs[i] - thumbs[reference])
+        diff = diff.reshape(GRID_SIZE, block, GRID_SIZE, block).mean(axis=(1, 3))
+        diff = diff.max() / 255
+        if i == 0 or diff > threshold:
+            reference = i
+        plan[path] = img_paths[reference]
+    return plan
+
+
+def get_inferred(plan):
+    """Get the set of frames of a plan that are inferred on."""
+    return {path for path, reference in plan.items() if path == reference}
+
+
+def get_agreement(plan, detections, iou_thres=0.5):
+    """Get the fraction of skipped frames whose reused detections agree with their own,
+    given a dictionary of each frame's detections from full inference.
+
+    Detections agree if neither has any, or if their most confident detections have the
+    same class and overlap by at least the IoU threshold. Returns None if no frames
+    were skipped.
+    """
+    skipped = [path for path, reference in plan.items() if path != reference]
+    if len(skipped) == 0:
+        return None
+    return float(
+        np.mean(
+            [
+                is_agreement(detections[plan[path]], detections[path], iou_thres)
+                for path in skipped
+            ]
+        )
+    )
+
+
+def is_agreement(detections, other, iou_thres=0.5):
+    if detections is None or other is None:
+        return detections is None and other is None
+    box, other_box = get_top_detection(detections), get_top_detection(other)
+    if int(box[6]) != int(other_box[6]):
+        return False
+    return float(yoloutils.bbox_iou(box[None, :4], other_box[None, :4])) >= iou_thres
+
+
+def get_top_detection(detections):
+    detections = detections.reshape(-1, 7)
+    return detections[(detections[:, 4] * detections[:, 5]).argmax()]
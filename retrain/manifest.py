@@ -0,0 +1,171 @@
+"""
+Run manifest recording the outputs of each stage of the pipeline, so that an interrupted
+run can resume without rerunning stages whose inputs have not changed.
+
+The manifest is an SQLite database in the output folder. Each stage output is recorded
+with a content hash, and each stage with a hash of its inputs. Content hashes are cached
+by file size and modification time, so checking a large checkpoint is usually a lookup.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+MANIFEST_NAME = "manifest.sqlite"
+
+_manifests = dict()
+
+
+def locked(method):
+    """Serialize calls to a Manifest method between threads."""
+
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def get_manifest(config):
+    """Get the manifest of the run with the given configuration, opening it once per
+    process."""
+    path = os.path.realpath(f"{config['output']}/{MANIFEST_NAME}")
+    if path not in _manifests.keys():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _manifests[path] = Manifest(path)
+    return _manifests[path]
+
+
+def hash_file(path, chunk_size=2 ** 20):
+    """Get the SHA-1 digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as in_file:
+        for chunk in iter(lambda: in_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_inputs(*inputs):
+    """Get a digest of JSON-serializable stage inputs. Sets are sorted first, and
+    functions are represented by their names."""
+
+    def default(obj):
+        if isinstance(obj, (set, frozenset)):
+            return sorted(obj)
+        if callable(obj) and hasattr(obj, "__name__"):
+            return obj.__name__
+        return str(obj)
+
+    encoded = json.dumps(inputs, sort_keys=True, default=default)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    """SQLite-backed record of pipeline stages and the files they produced."""
+
+    def __init__(self, path):
+        self.path = path
+        # Parallel sampling methods write to the same manifest, and threads within a
+        # process share a connection
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS files "
+                "(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS stages (stage TEXT, key TEXT, inputs TEXT, "
+                "outputs TEXT, time REAL, PRIMARY KEY (stage, key))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)"
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('created', ?)", (time.time(),)
+            )
+        self.created = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'created'"
+        ).fetchone()[0]
+
+    @locked
+    def get_digest(self, path):
+        """Get the content hash of a file, hashing it only if it changed since it was
+        last hashed. Returns None if the file does not exist."""
+        path = os.path.realpath(path)
+        if not os.path.exists(path):
+            return None
+
+        stat = os.stat(path)
+        row = self.conn.execute(
+            "SELECT size, mtime, digest FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+
+        digest = hash_file(path)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, digest),
+            )
+        return digest
+
+    @locked
+    def record(self, stage, key, outputs, inputs=None):
+        """Record that a stage finished, producing the given output files."""
+        outputs = [os.path.realpath(path) for path in outputs]
+        digests = [self.get_digest(path) for path in outputs]
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)",
+                (
+                    stage,
+                    str(key),
+                    inputs,
+                    json.dumps(dict(zip(outputs, digests))),
+                    time.time(),
+                ),
+            )
+
+    @locked
+    def is_done(self, stage, key, inputs=None, outputs=None):
+        """Check if a stage was recorded with the same inputs and its outputs are
+        unchanged.
+
+        Outputs written before the manifest was created, by a run that did not record
+        them, are adopted as done with the given inputs. Unrecorded outputs written
+        since then may be incomplete, so they are not trusted.
+        """
+        row = self.conn.execute(
+            "SELECT inputs, outputs FROM stages WHERE stage = ? AND key = ?",
+            (stage, str(key)),
+        ).fetchone()
+
+        if row is None:
+            if outputs is not None and all(
+                os.path.exists(path) and os.path.getmtime(path) < self.created
+                for path in outputs
+            ):
+                self.record(stage, key, outputs, inputs)
+                return True
+            return False
+
+        recorded_inputs, recorded_outputs = row
+        if inputs is not None and recorded_inputs != inputs:
+            return False
+        return all(
+            self.get_digest(path) == digest
+            for path, digest in json.loads(recorded_outputs).items()
+        )
+
+    @locked
+    def get_outputs(self, stage, key):
+        """Get the recorded output paths of a stage, or None if it was not recorded."""
+        row = self.conn.execute(
+            "SELECT outputs FROM stages WHERE stage = ? AND key = ?", (stage, str(key))
+        ).fetchone()
+        return None if row is None else list(json.loads(row[0]).keys())
@@ -7,27 +7,58 @@ import copy
 
 import userdefs
 from retrain import sampling as sample
-from retrain import utils, train
+from retrain import utils, train, stream, manifest, dedup
 from retrain.dataloader import LabeledSet
 import yolov3.utils as yoloutils
-from yolov3 import parallelize
+from yolov3 import parallelize, devices, shared
 import analysis.benchmark as bench
 import analysis.results as resloader
 
 
-def benchmark_sample(sample_method, imgs, config, batch_num, last_epoch):
+def get_bench_inputs(name, imgs, config, last_epoch):
+    """Get a digest of the inputs of a benchmark: its images, the contents of the
+    checkpoints it averages, and the thresholds and options of inference."""
+    run = manifest.get_manifest(config)
+    ckpts = [
+        bench.get_checkpoint(config["checkpoints"], name, epoch)
+        for epoch in bench.get_checkpoint_epochs(
+            1, last_epoch, config["conf_check_num"]
+        )
+    ]
+    bench_inputs = [
+        imgs.imgs,
+        [run.get_digest(ckpt) for ckpt in ckpts],
+        [config[key] for key in ("img_size", "conf_thres", "nms_thres", "iou_thres")],
+    ]
+    # Options that skip inference are only added if set, keeping earlier hashes valid
+    skip_options = {
+        key: config[key] for key in config.keys() if key in bench.SKIP_OPTIONS
+    }
+    if len(skip_options) != 0:
+        bench_inputs.append(skip_options)
+    return manifest.hash_inputs(*bench_inputs)
+
+
+def benchmark_sample(sample_method, imgs, config, batch_num, last_epoch, device=None):
     """Simulate benchmarking and sampling at the edge, returning a list of samples."""
     name, (sample_func, kwargs) = sample_method
-    bench_file = (
-        f"{config['output']}/{name}{batch_num}_benchmark_avg_1_{last_epoch}.csv"
-    )
 
-    if not os.path.exists(bench_file):
+    if "streaming" in config.keys() and config["streaming"]:
+        return stream_sample(sample_method, imgs, config, last_epoch, device)
+
+    bench_file = f"{config['output']}/{name}{batch_num}_benchmark_avg_1_{last_epoch}"
+    bench_file = resloader.get_bench_file(bench_file + resloader.get_bench_ext(config))
+
+    # The benchmark is rerun if its images, checkpoints or thresholds changed
+    run = manifest.get_manifest(config)
+    bench_inputs = get_bench_inputs(name, imgs, config, last_epoch)
+    if not run.is_done("benchmark", bench_file, bench_inputs, [bench_file]):
         results_df = bench.benchmark_avg(
-            imgs, name, 1, last_epoch, config["conf_check_num"], config,
+            imgs, name, 1, last_epoch, config["conf_check_num"], config, device=device
         )
 
         bench.save_results(results_df, bench_file)
+        run.record("benchmark", bench_file, [bench_file], bench_inputs)
 
     # Create samples from the benchmark
     results, _ = resloader.load_data(bench_file, by_actual=False)
@@ -40,33 +71,105 @@ def benchmark_sample(sample_method, imgs, config, batch_num, last_epoch):
     return sample_files
 
 
+def stream_sample(sample_method, imgs, config, last_epoch, device=None):
+    """Simulate deciding at the edge on each frame as it arrives, using a bandwidth limit
+    over a sliding window of one sampling batch."""
+    name, (sample_func, kwargs) = sample_method
+
+    frames = stream.inference_frames(
+        imgs, name, last_epoch, config["conf_check_num"], config, device
+    )
+
+    print(f"===== {name} (streaming) ======")
+    return stream.stream_sample(
+        frames, config["bandwidth"], config["sampling_batch"], sample_func, **kwargs
+    )
+
+
+def prepare_batch(sample_folder, config, label_func, cache=False):
+    """Label a batch of images and load what sampling it needs, none of which depends
+    on the latest checkpoint."""
+    classes = utils.load_classes(config["class_list"])
+    if not all(shared.is_labeled(img) for img in sample_folder.imgs):
+        sample_folder.label(classes, label_func)
+    sample_labeled = LabeledSet(sample_folder.imgs, len(classes), config["img_size"])
+
+    if "dedup_distance" in config.keys() and config["dedup_distance"] >= 0:
+        # Only one frame of each group of near-duplicates is benchmarked and sampled
+        clusters = dedup.cluster_images(sample_labeled.imgs, config["dedup_distance"])
+        dedup.save_clusters(
+            clusters, f"{config['output']}/{sample_folder.prefix}_clusters.json"
+        )
+        print(
+            f"Kept {len(clusters)} of {len(sample_labeled.imgs)} frames of "
+            f"{sample_folder.prefix} after removing near-duplicates"
+        )
+        sample_labeled.imgs = set(clusters.keys())
+        sample_labeled.labels = sample_labeled.get_labels()
+
+    if cache:
+        sample_labeled.get_label_index()
+        sample_labeled.cache_imgs()
+
+    return sample_labeled
+
+
 def sample_retrain(
-    sample_method, batches, config, last_epoch, seen_images, label_func, device=None,
+    sample_method,
+    batches,
+    config,
+    last_epoch,
+    seen_images,
+    label_func,
+    shared_state=None,
+    device=None,
 ):
-    """Run the sampling and retraining pipeline for a particular sampling function."""
+    """Run the sampling and retraining pipeline for a particular sampling function.
+
+    If prefetching is enabled, the next batch is labeled and loaded into memory while
+    the current batch is benchmarked, sampled and trained on. Baseline checkpoints and
+    labels are read from the shared state, if given.
+    """
+    if shared_state is not None:
+        shared_state.attach()
+
     name, _ = sample_method
     classes = utils.load_classes(config["class_list"])
     seen_images = copy.deepcopy(seen_images)
-    for i, sample_folder in enumerate(batches):
-        sample_folder.label(classes, label_func)
-        sample_labeled = LabeledSet(
-            sample_folder.imgs, len(classes), config["img_size"],
-        )
 
+    prefetch = "prefetch" in config.keys() and config["prefetch"]
+    prepared_batches = utils.prefetch(
+        lambda batch: prepare_batch(batch, config, label_func, cache=prefetch),
+        batches,
+        enabled=prefetch,
+    )
+
+    run = manifest.get_manifest(config)
+    for i, sample_labeled in enumerate(prepared_batches):
         sample_filename = f"{config['output']}/{name}{i}_sample_{last_epoch}.txt"
-        if os.path.exists(sample_filename):
+        # Samples are redone if the benchmark (or streamed inference) they were drawn
+        # from would change, such as after the checkpoints are retrained
+        sample_inputs = manifest.hash_inputs(
+            sample_method,
+            sample_labeled.imgs,
+            config["bandwidth"],
+            "streaming" in config.keys() and config["streaming"],
+            get_bench_inputs(name, sample_labeled, config, last_epoch),
+        )
+        if run.is_done("sample", sample_filename, sample_inputs, [sample_filename]):
             print("Loading existing samples")
             retrain_files = open(sample_filename, "r").read().split("\n")
 
         else:
             retrain_files = benchmark_sample(
-                sample_method, sample_labeled, config, i, last_epoch
+                sample_method, sample_labeled, config, i, last_epoch, device
             )
 
             # When deploying at the edge, this would be where data is
             # sent from nodes to the Beehive, along with the benchmark file
             with open(sample_filename, "w+") as out:
                 out.write("\n".join(retrain_files))
+            run.record("sample", sample_filename, [sample_filename], sample_inputs)
 
         # Receive raw sampled data in the cloud
         # This process simulates manually labeling/verifying all inferences
@@ -110,11 +213,10 @@ def sample_retrain(
 
 def retrain(config, sample_methods, sample_batches, base_epoch, init_imgs):
     """Sample images and retrain for all sample methods given."""
-    free_gpus = yoloutils.get_free_gpus(yoloutils.get_memory_needed(config))
+    memory_needed = yoloutils.get_memory_needed(config)
 
     grouped_args = list()
-    for i, sample_method in enumerate(sample_methods.items()):
-        device = free_gpus[i % len(free_gpus)]
+    for sample_method in sample_methods.items():
         method_args = (
             sample_method,
             sample_batches,
@@ -122,12 +224,49 @@ def retrain(config, sample_methods, sample_batches, base_epoch, init_imgs):
             base_epoch,
             init_imgs,
             userdefs.label_sample_set,
-            device,
         )
         grouped_args.append(method_args)
 
         if not config["parallel"]:
-            sample_retrain(*method_args)
+            # Claim a GPU for the sample method, or None to train on the CPU
+            device = devices.manager.reserve(memory_needed)
+            try:
+                sample_retrain(*method_args, device=device)
+            finally:
+                devices.manager.release(device, memory_needed)
 
     if config["parallel"]:
-        parallelize.run_parallel(sample_retrain, grouped_args)
+        shared_state = share_baseline(config, sample_batches, base_epoch)
+        grouped_args = [method_args + (shared_state,) for method_args in grouped_args]
+
+        # Each worker is given a device slot for the methods it runs
+        parallelize.run_parallel(
+            sample_retrain, grouped_args, memory_needed=memory_needed, pass_device=True
+        )
+
+
+def share_baseline(config, sample_batches, base_epoch):
+    """Load the baseline checkpoints and label the sampling batches once, so that
+    parallel sampling methods can use them through shared memory.
+
+    Returns None if shared memory is unavailable.
+    """
+    shared_state = shared.SharedState()
+    epochs = bench.get_checkpoint_epochs(1, base_epoch, config["conf_check_num"])
+    try:
+        shared_state.add_checkpoint(utils.find_checkpoint(config, "init", base_epoch))
+        for epoch in epochs:
+            shared_state.add_checkpoint(
+                bench.get_checkpoint(config["checkpoints"], "init", epoch)
+            )
+
+        for sample_folder in sample_batches:
+            sample_labeled = prepare_batch(
+                sample_folder, config, userdefs.label_sample_set
+            )
+            shared_state.add_labels(sample_labeled, sample_folder.imgs)
+    except RuntimeError as e:
+        print(f"Could not share baseline state between processes: {e}")
+        return None
+
+    return shared_state
@@ -4,6 +4,7 @@ Functions to create samples from a ClassResults object.
 Add new sampling functions here as needed, or add them to userdefs.py.
 """
 
+import heapq
 import random
 
 import statistics as stats
@@ -56,20 +57,20 @@ def prob_sample(result, desired, prob_func, *func_args, **func_kwargs):
     The function continues sampling until the desired number of samples is hit.
     Consequently, the probability function should be well-chosen to prevent long runtimes.
     """
-    pool = result.get_all()
+    order = result.outcome_order
+    pool = list(zip(result.get_files()[order].tolist(), result.conf[order].tolist()))
     chosen = set()
 
     while len(chosen) < desired:
-        chosen_this_round = list()
+        not_chosen = list()
         random.shuffle(pool)
-        for row in pool:
-            conf = row["conf"]
+        for file, conf in pool:
             choose = random.random() <= prob_func(conf, *func_args, **func_kwargs)
             if choose:
-                chosen_this_round.append(row)
-        for row in chosen_this_round:
-            pool.remove(row)
-            chosen.add(row["file"])
+                chosen.add(file)
+            else:
+                not_chosen.append((file, conf))
+        pool = not_chosen
 
     chosen = list(chosen)[:desired]
     return chosen
@@ -112,9 +113,10 @@ def bin_sample(result, num_bins, curve, start=0.0, end=1.0, **func_kwargs):
 
 
 def in_range_sample(result, min_val, max_val):
-    return [
-        res["file"] for res in result.get_all() if max_val >= res["conf"] >= min_val
-    ]
+    order = result.outcome_order
+    conf = result.conf[order]
+    in_range_mask = (conf >= min_val) & (conf <= max_val)
+    return result.get_files()[order][in_range_mask].tolist()
 
 
 def median_thresh_sample(result, thresh=0.5):
@@ -161,7 +163,98 @@ def normal_sample(result, avg=None, stdev=None, p=0.75, thresh=0.5):
 
 def in_range(result, min_val, max_val=1.0):
     """Get the number of elements in a ClassResult above a threshold."""
-    return len([res for res in result.get_all() if max_val > res["conf"] >= min_val])
+    return int(np.count_nonzero((result.conf >= min_val) & (result.conf < max_val)))
+
+
+class WeightedReservoir:
+    """Fixed-size weighted random sample over a stream of items, using the A-Res algorithm
+    (Efraimidis and Spirakis, 2006)."""
+
+    def __init__(self, size, rand):
+        self.size = size
+        self.random = rand
+        self.heap = list()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, item, weight):
+        if weight <= 0.0 or self.size == 0:
+            return
+        key = self.random.random() ** (1 / weight)
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, (key, item))
+        elif key > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (key, item))
+
+    def flush(self):
+        """Empty the reservoir, returning its items by descending priority."""
+        items = [item for _, item in sorted(self.heap, reverse=True)]
+        self.heap = list()
+        return items
+
+
+class ReservoirSampler:
+    """Bandwidth-bounded sampler keeping a weighted reservoir per inferred class.
+
+    Images are weighted by a curve (e.g. const or norm) of the confidence of each of their
+    labels, so memory is bounded by the bandwidth rather than the batch size.
+    """
+
+    def __init__(self, bandwidth, curve, stratify=True, **curve_kwargs):
+        self.random = random.Random("sage")
+        self.bandwidth = bandwidth
+        self.curve = curve
+        self.curve_kwargs = curve_kwargs
+        self.stratify = stratify
+        self.reservoirs = dict()
+
+    def add(self, path, detections):
+        """Offer an image, given a list of (class name, confidence) tuples for its labels."""
+        if len(detections) == 0:
+            detections = [(str(), 0.0)]
+
+        # Offer the image once per class, with its most heavily weighted label
+        weights = dict()
+        for name, conf in detections:
+            key = name if self.stratify else "All"
+            weight = self.curve(conf, **self.curve_kwargs)
+            weights[key] = max(weight, weights.get(key, 0.0))
+
+        for key, weight in weights.items():
+            if key not in self.reservoirs.keys():
+                self.reservoirs[key] = WeightedReservoir(self.bandwidth, self.random)
+            self.reservoirs[key].add(path, weight)
+
+    def flush(self):
+        """Get the images to upload for the current interval and empty the reservoirs.
+
+        Like create_sample(), the bandwidth is distributed among the classes with the fewest
+        candidates first. Exactly bandwidth images are returned if enough were offered.
+        """
+        by_class = sorted(
+            (reservoir.flush() for reservoir in self.reservoirs.values()), key=len
+        )
+        self.reservoirs = dict()
+
+        chosen = list()
+        for i, class_imgs in enumerate(by_class):
+            images_left = self.bandwidth - len(chosen)
+            images_per_class = round(images_left / (len(by_class) - i))
+            chosen += self.unchosen(class_imgs, chosen)[:images_per_class]
+
+        # Fill in quota left over from images shared between classes
+        for class_imgs in reversed(by_class):
+            if len(chosen) >= self.bandwidth:
+                break
+            chosen += self.unchosen(class_imgs, chosen)[: self.bandwidth - len(chosen)]
+
+        return chosen
+
+    @staticmethod
+    def unchosen(imgs, chosen):
+        chosen = set(chosen)
+        return [img for img in imgs if img not in chosen]
 
 
 def sample_histogram(retrain, title):
@@ -171,7 +264,7 @@ def sample_histogram(retrain, title):
     miss = list()
 
     for data in retrain:
-        if data["hit"] == "True":
+        if str(data["hit"]) == "True":
             hit.append(data["conf"])
         else:
             miss.append(data["conf"])
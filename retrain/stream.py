@@ -0,0 +1,404 @@
+"""
+Streaming counterparts of the batch sampling functions in sampling.py.
+
+Instead of benchmarking a whole batch before sampling, frames are consumed one at a time
+from a generator and a decision to transmit each frame is made as soon as it is inferred.
+Per-class confidence statistics are kept as running estimates in constant memory, and
+the bandwidth limit is enforced over a sliding window of frames. The batch sampling
+functions remain the offline reference for these decisions.
+"""
+
+import math
+import random
+import itertools
+import functools
+from collections import deque
+
+import numpy as np
+import scipy.integrate as integrate
+import torch
+from torch.utils.data import DataLoader
+
+from retrain import sampling
+from retrain import utils
+from retrain.dataloader import ImageFolder
+from yolov3 import evaluate, models
+from yolov3 import utils as yoloutils
+import analysis.benchmark as bench
+import analysis.results as rload
+
+
+class P2Quantile:
+    """Running estimate of a single quantile using the P-square algorithm
+    (Jain and Chlamtac, 1985), which stores only five markers."""
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = list()
+        self.pos = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.incr = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(x)
+            heights.sort()
+            return
+
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = max(i for i in range(4) if heights[i] <= x)
+
+        for i in range(k + 1, 5):
+            self.pos[i] += 1
+        for i in range(5):
+            self.desired[i] += self.incr[i]
+
+        # Adjust the heights of the middle markers if they are off their desired position
+        for i in range(1, 4):
+            delta = self.desired[i] - self.pos[i]
+            if (delta >= 1 and self.pos[i + 1] - self.pos[i] > 1) or (
+                delta <= -1 and self.pos[i - 1] - self.pos[i] < -1
+            ):
+                step = 1 if delta > 0 else -1
+                height = self.parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self.linear(i, step)
+                heights[i] = height
+                self.pos[i] += step
+
+    def parabolic(self, i, step):
+        q, n = self.heights, self.pos
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def linear(self, i, step):
+        q, n = self.heights, self.pos
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    def value(self):
+        if len(self.heights) == 0:
+            return None
+        if len(self.heights) < 5:
+            # Exact quantile with midpoint interpolation, as in iqr_sample
+            idx = self.p * (len(self.heights) - 1)
+            return (self.heights[math.floor(idx)] + self.heights[math.ceil(idx)]) / 2
+        return self.heights[2]
+
+
+class RunningStats:
+    """Constant-memory summary of a stream of confidences for one class."""
+
+    def __init__(self, hist_bins=100):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.q1 = P2Quantile(0.25)
+        self.q2 = P2Quantile(0.5)
+        self.q3 = P2Quantile(0.75)
+        self.hist = np.zeros(hist_bins, dtype=np.int64)
+
+    def add(self, conf):
+        # Welford's algorithm for the running mean and variance
+        self.count += 1
+        delta = conf - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (conf - self.mean)
+
+        for quantile in (self.q1, self.q2, self.q3):
+            quantile.add(conf)
+        self.hist[self.hist_index(conf)] += 1
+
+    def hist_index(self, conf):
+        return min(max(int(conf * len(self.hist)), 0), len(self.hist) - 1)
+
+    def stdev(self):
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def median(self):
+        return self.q2.value()
+
+    def count_in(self, min_val, max_val):
+        """Approximate number of confidences in [min_val, max_val)."""
+        lower = self.hist_index(min_val)
+        upper = len(self.hist) if max_val >= 1.0 else self.hist_index(max_val)
+        return int(self.hist[lower:upper].sum())
+
+
+class BandwidthWindow:
+    """Enforce a maximum number of transmitted frames over a sliding window of frames."""
+
+    def __init__(self, bandwidth, window):
+        self.bandwidth = bandwidth
+        self.window = window
+        self.sent = deque(maxlen=bandwidth)
+
+    def allow(self, frame_i):
+        while len(self.sent) != 0 and self.sent[0] <= frame_i - self.window:
+            self.sent.popleft()
+        return len(self.sent) < self.bandwidth
+
+    def record(self, frame_i):
+        self.sent.append(frame_i)
+
+
+def median_rule(thresh=0.5, below=False):
+    def rule(stats, conf):
+        median = stats.median()
+        return float(conf <= median if below else conf >= median)
+
+    return rule, thresh
+
+
+def iqr_rule(thresh=0.5):
+    def rule(stats, conf):
+        return float(stats.q3.value() >= conf >= stats.q1.value())
+
+    return rule, thresh
+
+
+def normal_rule(avg=None, stdev=None, p=0.75, thresh=0.5):
+    def rule(stats, conf):
+        mean = stats.mean if avg is None else avg
+        std = stats.stdev() if stdev is None else stdev
+        if not std:
+            return p
+        # Normal PDF scaled to a peak probability of p
+        return p * math.exp(-0.5 * ((conf - mean) / std) ** 2)
+
+    return rule, thresh
+
+
+def in_range_rule(min_val, max_val):
+    def rule(_, conf):
+        return float(max_val >= conf >= min_val)
+
+    return rule, 0.0
+
+
+def bin_rule(num_bins, curve, start=0.0, end=1.0, **func_kwargs):
+    delta = (end - start) / num_bins
+    total_area = integrate.quad(lambda x: curve(x, **func_kwargs), start, end)[0]
+    bin_props = [
+        integrate.quad(
+            lambda x: curve(x, **func_kwargs),
+            start + i * delta,
+            start + (i + 1) * delta,
+        )[0]
+        / total_area
+        for i in range(num_bins)
+    ]
+
+    def rule(stats, conf):
+        if not end >= conf >= start:
+            return 0.0
+        i = min(int((conf - start) / delta), num_bins - 1)
+        seen = stats.count_in(start + i * delta, start + (i + 1) * delta)
+        if seen == 0:
+            return 1.0
+        # Ratio of the desired number of images in the bin to those seen so far
+        return min(1.0, bin_props[i] * stats.count / seen)
+
+    return rule, 0.0
+
+
+STREAM_RULES = {
+    sampling.median_thresh_sample: median_rule,
+    sampling.median_below_thresh_sample: functools.partial(median_rule, below=True),
+    sampling.iqr_sample: iqr_rule,
+    sampling.normal_sample: normal_rule,
+    sampling.in_range_sample: in_range_rule,
+    sampling.bin_sample: bin_rule,
+}
+
+
+class StreamSampler:
+    """Per-frame sampler mirroring create_sample() for a batch sampling function."""
+
+    def __init__(self, sample_func, bandwidth, window, stratify=True, **func_args):
+        """
+        Parameters:
+            sample_func (function): batch sampling function from sampling.py to emulate
+            bandwidth (int): maximum number of frames to transmit within a window
+            window (int): number of consecutive frames the bandwidth limit applies to
+            stratify (bool): keep confidence statistics per inferred class
+            func_args: keyword arguments of the batch sampling function
+        """
+        if sample_func not in STREAM_RULES.keys():
+            raise ValueError(f"No streaming rule for {sample_func.__name__}")
+        self.rule, self.thresh = STREAM_RULES[sample_func](**func_args)
+        self.stratify = stratify
+        self.limit = BandwidthWindow(bandwidth, window)
+        self.stats = dict()
+        self.frame_i = -1
+        self.random = random.Random("sage")
+
+    def get_stats(self, name):
+        key = name if self.stratify else "All"
+        if key not in self.stats.keys():
+            self.stats[key] = RunningStats()
+        return self.stats[key]
+
+    def decide(self, detections):
+        """Decide if a frame should be transmitted, given a list of (class name, confidence)
+        tuples for its inferred labels. Frames without detections are a single empty label
+        with a confidence of 0."""
+        self.frame_i += 1
+        if len(detections) == 0:
+            detections = [(str(), 0.0)]
+
+        chosen = False
+        for name, conf in detections:
+            stats = self.get_stats(name)
+            if conf >= self.thresh:
+                stats.add(conf)
+            if stats.count != 0 and self.random.random() < self.rule(stats, conf):
+                chosen = True
+
+        if chosen and self.limit.allow(self.frame_i):
+            self.limit.record(self.frame_i)
+            return True
+        return False
+
+
+def stream_sample(frames, bandwidth, window, sample_func, stratify=True, **func_args):
+    """Streaming analog of create_sample(), consuming (image path, detections) frames."""
+    sampler = StreamSampler(sample_func, bandwidth, window, stratify, **func_args)
+    return [path for path, detections in frames if sampler.decide(detections)]
+
+
+def inference_frames(img_folder, prefix, end, total_epochs, config, device=None):
+    """Yield the averaged detections of each image in a folder as it is inferred, using
+    linearly-spaced checkpoints up to the given epoch, on the given GPU index if any."""
+    classes = utils.load_classes(config["class_list"])
+    model_def = yoloutils.parse_model_config(config["model_config"])
+    ensemble = [
+        models.get_eval_model(
+            model_def,
+            config["img_size"],
+            bench.get_checkpoint(config["checkpoints"], prefix, epoch),
+            device,
+        )
+        for epoch in bench.get_checkpoint_epochs(1, end, total_epochs)
+    ]
+
+    loader = DataLoader(
+        img_folder,
+        batch_size=1,
+        shuffle=False,
+        # Cached images are already decoded, so worker processes would only add copies
+        num_workers=0 if len(img_folder.img_cache) != 0 else config["n_cpu"],
+    )
+    for (img_paths, input_imgs) in loader:
+        # Images are converted to floats once for all models of the ensemble
+        input_imgs = evaluate.to_model_input(input_imgs, ensemble[0].device)
+        detections = list()
+        for model in ensemble:
+            detections += evaluate.detect(
+                input_imgs, config["conf_thres"], model, config["nms_thres"]
+            )
+        detections = [d for d in detections if d is not None]
+
+        if len(detections) == 0:
+            yield img_paths[0], list()
+            continue
+
+        regions, _ = yoloutils.group_average_bb(
+            torch.cat(detections, 0).unsqueeze(0), total_epochs, config["iou_thres"]
+        )
+        yield img_paths[0], [
+            (classes[int(pred_class)], float(obj_conf * class_conf))
+            for obj_conf, class_conf, pred_class in regions.numpy()[:, 4:]
+        ]
+
+
+def benchmark_frames(bench_file):
+    """Replay the rows of a benchmark file as a stream of (image path, detections) frames.
+
+    Rows of missed ground truths are dropped, as they are not known at the edge.
+    """
+    cols = rload.read_columns(bench_file, ["file", "detected", "conf"])
+    rows = zip(cols["file"].tolist(), cols["detected"].tolist(), cols["conf"].tolist())
+    for path, frame_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        yield path, [
+            (detected, conf) for _, detected, conf in frame_rows if detected != str()
+        ]
+
+
+def batch_frames(batch_file, prefix, config):
+    """Replay a sample*.txt batch split in feed order, using its benchmark from the sampling
+    pipeline if available and running inference otherwise."""
+    batch_num = utils.get_sample(batch_file)
+    imgs = utils.get_lines(batch_file)
+    bench_files = rload.glob_bench_files(
+        f"{config['output']}/{prefix}{batch_num}_benchmark_avg_1_*"
+        + rload.get_bench_ext(config)
+    )
+
+    if len(bench_files) != 0:
+        detections = dict(benchmark_frames(bench_files[0]))
+        return ((img, detections.get(img, list())) for img in imgs)
+
+    last_epoch = utils.get_epoch_splits(config, prefix, True)[batch_num]
+    folder = ImageFolder(imgs, config["img_size"])
+    return inference_frames(
+        folder, prefix, last_epoch, config["conf_check_num"], config
+    )
+
+
+def simulate_reservoir(
+    frames, bandwidth, interval, curve, stratify=True, **curve_kwargs
+):
+    """Run frames through a reservoir sampler, uploading its contents every interval frames.
+
+    Returns a list of the images uploaded at each interval.
+    """
+    sampler = sampling.ReservoirSampler(bandwidth, curve, stratify, **curve_kwargs)
+    uploads = list()
+    frame_i = 0
+    for frame_i, (path, detections) in enumerate(frames, start=1):
+        sampler.add(path, detections)
+        if frame_i % interval == 0:
+            uploads.append(sampler.flush())
+
+    if frame_i % interval != 0:
+        uploads.append(sampler.flush())
+    return uploads
+
+
+def reservoir_batch(sample_method, config, batch_num, interval=None):
+    """Simulate reservoir sampling on a batch split with the curve of a bin sampling method,
+    saving the uploaded images for each interval."""
+    prefix, (_, kwargs) = sample_method
+    kwargs = dict(kwargs)
+    if "curve" not in kwargs.keys():
+        raise ValueError(f"Sampling method {prefix} does not have a weight curve")
+    curve = kwargs.pop("curve")
+    stratify = kwargs.pop("stratify", True)
+    for key in ("num_bins", "start", "end"):
+        kwargs.pop(key, None)
+
+    if interval is None:
+        interval = config["sampling_batch"]
+
+    frames = batch_frames(f"{config['output']}/sample{batch_num}.txt", prefix, config)
+    uploads = simulate_reservoir(
+        frames, config["bandwidth"], interval, curve, stratify, **kwargs
+    )
+
+    for i, upload in enumerate(uploads):
+        filename = f"{config['output']}/{prefix}{batch_num}_reservoir_{i}.txt"
+        with open(filename, "w+") as out:
+            out.write("\n".join(upload))
+        print(f"Interval {i}: uploaded {len(upload)} images to {filename}")
+    return uploads
@@ -11,13 +11,12 @@ import datetime
 import torch
 from torch.autograd import Variable
 
-from terminaltables import AsciiTable
-
-from yolov3 import evaluate, models
+from yolov3 import evaluate, models, shared
+from yolov3 import metrics as yolometrics
 from yolov3.logger import Logger
 import yolov3.utils as yoloutils
 
-from retrain import utils
+from retrain import utils, manifest, checkpoints
 
 
 def train_initial(init_folder, config):
@@ -28,17 +27,25 @@ def train_initial(init_folder, config):
     return end_epoch
 
 
-def save_ckpt(model, prefix, epoch, ckpt_folder):
+def save_ckpt(model, prefix, epoch, ckpt_folder, run=None, store=None, writer=None):
     if hasattr(model, "module"):
         state_dict = model.module.state_dict()
     else:
         state_dict = model.state_dict()
-    torch.save(
-        state_dict, f"{ckpt_folder}/{prefix}_ckpt_{epoch}.pth",
-    )
+    if writer is not None:
+        writer.submit(state_dict, prefix, epoch)
+        return
+    if store is None:
+        store = checkpoints.CheckpointStore(ckpt_folder)
+    ckpt_path = store.save(state_dict, prefix, epoch)
+    if run is not None:
+        run.record("checkpoint", ckpt_path, [ckpt_path])
 
 
 def train_epoch(dataloader, epoch, end_epoch, model, optimizer, metrics, logger, opt):
+    verbosity = opt["log_verbosity"] if "log_verbosity" in opt.keys() else 2
+    tracker = yolometrics.MetricsTracker(model, metrics)
+
     start_time = time.time()
     for batch_i, (_, imgs, targets) in enumerate(dataloader):
         batches_done = len(dataloader) * epoch + batch_i
@@ -56,7 +63,21 @@ def train_epoch(dataloader, epoch, end_epoch, model, optimizer, metrics, logger,
             optimizer.step()
             optimizer.zero_grad()
 
-        # Log progress
+        model.seen += imgs.size(0)
+        tracker.update(loss)
+
+        # Metrics are only copied from the device at the log interval
+        last_batch = batch_i == len(dataloader) - 1
+        if batch_i % logger.log_interval != 0 and not last_batch:
+            continue
+
+        loss_avg, layers = tracker.summarize()
+        logger.list_of_scalars_summary(
+            yolometrics.get_scalars(loss_avg, layers), batches_done
+        )
+
+        if verbosity == 0:
+            continue
 
         log_str = "\n---- [Epoch %d/%d, Batch %d/%d] ----\n" % (
             epoch,
@@ -65,34 +86,10 @@ def train_epoch(dataloader, epoch, end_epoch, model, optimizer, metrics, logger,
             len(dataloader),
         )
 
-        metric_table = [
-            ["Metrics", *[f"YOLO Layer {i}" for i in range(len(model.yolo_layers))]]
-        ]
-
         # Log metrics at each YOLO layer
-        for metric in metrics:
-            formats = {m: "%.6f" for m in metrics}
-            formats["grid_size"] = "%2d"
-            formats["cls_acc"] = "%.2f%%"
-            row_metrics = [
-                formats[metric] % yolo.metrics.get(metric, 0)
-                for yolo in model.yolo_layers
-            ]
-            metric_table += [[metric, *row_metrics]]
-
-            # Tensorboard logging
-            tensorboard_log = []
-            for j, yolo in enumerate(model.yolo_layers):
-                for name, yolo_metric in yolo.metrics.items():
-                    if name != "grid_size":
-                        tensorboard_log += [(f"{name}_{j+1}", yolo_metric)]
-            tensorboard_log += [("loss", loss.item())]
-
-            if batch_i % logger.log_interval == 0:
-                logger.list_of_scalars_summary(tensorboard_log, batches_done)
-
-        log_str += AsciiTable(metric_table).table
-        log_str += f"\nTotal loss {loss.item()}"
+        if verbosity >= 2:
+            log_str += yolometrics.format_table(layers, metrics) + "\n"
+        log_str += f"Total loss {loss_avg}"
 
         # Determine approximate time left for epoch
         epoch_batches_left = len(dataloader) - (batch_i + 1)
@@ -103,8 +100,6 @@ def train_epoch(dataloader, epoch, end_epoch, model, optimizer, metrics, logger,
 
         print(log_str)
 
-        model.seen += imgs.size(0)
-
 
 def train(img_folder, opt, load_weights=None, device=None):
     """Trains a given image set, with an early stop.
@@ -114,8 +109,8 @@ def train(img_folder, opt, load_weights=None, device=None):
             and validation sets.
         opt (dict): Configuration dictionary with hyperparameters for training
         load_weights (str): Path of initial weights, if training is resumed from a checkpoint.
-        device (str): PyTorch CUDA string of a GPU device. Looks for available devices if
-            none is provided.
+        device (int): Index of a GPU reserved for training. Looks for available devices
+            if none is provided.
     Returns:
         last_epoch (int): the epoch number where training was ended
     """
@@ -131,7 +126,9 @@ def train(img_folder, opt, load_weights=None, device=None):
     model.apply(yoloutils.weights_init_normal)
 
     if load_weights is not None:
-        model.load_state_dict(torch.load(load_weights, map_location=model.device))
+        model.load_state_dict(
+            shared.load_state_dict(load_weights, map_location=model.device)
+        )
 
     class_names = utils.load_classes(opt["class_list"])
 
@@ -175,53 +172,79 @@ def train(img_folder, opt, load_weights=None, device=None):
     successive_stops = 0
     prev_strip_loss = float("inf")
 
+    # Checkpoints are resumed from if they were fully written
+    run = manifest.get_manifest(opt)
+    store = checkpoints.get_store(opt)
+    writer = checkpoints.CheckpointWriter(store, run)
+
     end_epoch = opt["start_epoch"] + opt["max_epochs"]
     last_epoch = opt["start_epoch"]
 
-    for epoch in range(opt["start_epoch"], end_epoch):
-        last_epoch = epoch
-        model.train()
-
-        ckpt_path = f"{opt['checkpoints']}/{img_folder.prefix}_ckpt_{epoch}.pth"
-
-        if not os.path.exists(ckpt_path):
-            train_epoch(
-                dataloader, epoch, end_epoch, model, optimizer, metrics, logger, opt
-            )
-            if epoch % opt["checkpoint_interval"] == 0:
-                save_ckpt(model, img_folder.prefix, epoch, opt["checkpoints"])
-
-        else:
-            model.load_state_dict(torch.load(ckpt_path))
+    try:
+        for epoch in range(opt["start_epoch"], end_epoch):
+            last_epoch = epoch
+            model.train()
+
+            ckpt_path = f"{opt['checkpoints']}/{img_folder.prefix}_ckpt_{epoch}.pth"
+
+            if not run.is_done("checkpoint", ckpt_path, outputs=[ckpt_path]):
+                train_epoch(
+                    dataloader, epoch, end_epoch, model, optimizer, metrics, logger, opt
+                )
+                if epoch % opt["checkpoint_interval"] == 0:
+                    save_ckpt(
+                        model,
+                        img_folder.prefix,
+                        epoch,
+                        opt["checkpoints"],
+                        writer=writer,
+                    )
 
-        # Use UP criteria for early stop
-        if bool(opt["early_stop"]) and (
-            epoch == opt["start_epoch"] or epoch % opt["strip_len"] == 0
-        ):
-            print(f"\n---Evaluating validation set on epoch {epoch} for early stop---")
-
-            valid_results = evaluate.get_results(
-                model, img_folder.valid, opt, class_names, logger, epoch
-            )
-
-            if valid_results["val_loss"] > prev_strip_loss:
-                successive_stops += 1
             else:
-                successive_stops = 0
-            print(f"Previous loss: {prev_strip_loss}")
-            print(f"Current loss: {valid_results['val_loss']}")
-
-            prev_strip_loss = valid_results["val_loss"]
-
-            if successive_stops == opt["successions"]:
-                print(f"Early stop at epoch {epoch}")
-                break
-
-        if epoch % opt["evaluation_interval"] == 0:
-            print(f"\n---Evaluating test set on epoch {epoch}---")
-            evaluate.get_results(
-                model, img_folder.test, opt, class_names, logger, epoch
-            )
+                model.load_state_dict(
+                    checkpoints.load_state_dict(ckpt_path, map_location=model.device)
+                )
+
+            # Use UP criteria for early stop
+            if bool(opt["early_stop"]) and (
+                epoch == opt["start_epoch"] or epoch % opt["strip_len"] == 0
+            ):
+                print(
+                    f"\n---Evaluating validation set on epoch {epoch} for early stop---"
+                )
+
+                valid_results = evaluate.get_results(
+                    model, img_folder.valid, opt, class_names, logger, epoch
+                )
+
+                if valid_results["val_loss"] > prev_strip_loss:
+                    successive_stops += 1
+                else:
+                    successive_stops = 0
+                print(f"Previous loss: {prev_strip_loss}")
+                print(f"Current loss: {valid_results['val_loss']}")
+
+                prev_strip_loss = valid_results["val_loss"]
+
+                if successive_stops == opt["successions"]:
+                    print(f"Early stop at epoch {epoch}")
+                    break
+
+            if epoch % opt["evaluation_interval"] == 0:
+                print(f"\n---Evaluating test set on epoch {epoch}---")
+                evaluate.get_results(
+                    model, img_folder.test, opt, class_names, logger, epoch
+                )
+    except BaseException:
+        # Still wait for checkpoints to be written, without hiding the error that
+        # stopped training behind one from the writer
+        try:
+            writer.close()
+        except RuntimeError as e:
+            print(f"{e} after training failed: {e.__cause__}")
+        raise
+
+    writer.close()
 
     yoloutils.clear_vram()
     return last_epoch
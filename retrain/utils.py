@@ -10,12 +10,18 @@ import sys
 import os
 import glob
 import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+from retrain import checkpoints
 
 
 def find_checkpoint(config, prefix, num):
-    ckpt = f"{config['checkpoints']}/init_ckpt_{num}.pth"
-    if not os.path.exists(ckpt):
-        ckpt = glob.glob(f"{config['checkpoints']}/{prefix}*_ckpt_{num}.pth")[0]
+    registry = checkpoints.get_registry(config["checkpoints"])
+    ckpt = registry.find("init", num, batch="")
+    if ckpt is None:
+        ckpt = registry.find(prefix, num)
+    if ckpt is None:
+        raise FileNotFoundError(f"No checkpoint for {prefix} at epoch {num}")
     return ckpt
 
 
@@ -33,8 +39,8 @@ def get_epoch_splits(config, prefix, incl_last_epoch=False):
         for file in sort_by_epoch(f"{config['output']}/{prefix}*sample*.txt")
     ]
     if incl_last_epoch:
-        last_checkpoint = sort_by_epoch(f"{config['checkpoints']}/{prefix}*.pth")[-1]
-        splits.append(get_epoch(last_checkpoint))
+        registry = checkpoints.get_registry(config["checkpoints"])
+        splits.append(registry.get_epochs(prefix)[-1])
     return splits
 
 
@@ -86,6 +92,27 @@ def save_stdout(filename, func, *pos_args, **var_args):
     sys.stdout = old_stdout
 
 
+def prefetch(func, items, enabled=True):
+    """Yield func(item) for each item in order. While a result is being used, the
+    next item is prepared in a background thread.
+
+    If not enabled, each item is prepared only when it is needed.
+    """
+    if not enabled:
+        for item in items:
+            yield func(item)
+        return
+
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_result = executor.submit(func, items[0]) if len(items) != 0 else None
+        for i in range(len(items)):
+            result = next_result.result()
+            if i + 1 < len(items):
+                next_result = executor.submit(func, items[i + 1])
+            yield result
+
+
 def xyxy_to_darknet(img_path, x0, y0, x1, y1):
 
     img = cv2.imread(img_path)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+
+@pytest.fixture
+def static_camera(tmp_path):
+    """Save the frames of a simulated static camera, where the scene changes every few
+    frames and frames differ by sensor noise otherwise. Scenes hold a vehicle of one of
+    three classes, except every fourth scene, which is empty.
+
+    Returns a dictionary of frame paths and the detections of the vehicle in each frame,
+    standing in for full inference.
+    """
+
+    def make(num_imgs, width=320, change_every=10, seed=0):
+        rand = np.random.default_rng(seed)
+        height = width * 9 // 16
+        colors = [(200, 30, 30), (30, 200, 30), (30, 30, 200)]
+        background = rand.integers(0, 256, (height // 16, width // 16, 3), np.uint8)
+        background = np.array(
+            Image.fromarray(background).resize((width, height), Image.BILINEAR)
+        )
+
+        detections = dict()
+        for i in range(num_imgs):
+            if i % change_every == 0:
+                scene = background.copy()
+                vehicle = None
+                if (i // change_every) % 4 != 3:
+                    x = int(rand.integers(0, width * 3 // 4))
+                    y = int(rand.integers(0, height * 3 // 4))
+                    w, h = width // 4, height // 4
+                    cls = int(rand.integers(0, len(colors)))
+                    scene[y : y + h, x : x + w] = colors[cls]
+                    vehicle = torch.tensor([[[x, y, x + w, y + h, 1.0, 1.0, cls]]])
+                    vehicle = vehicle.float()
+            frame = np.clip(scene + rand.normal(0, 2, scene.shape), 0, 255)
+            path = f"{tmp_path}/frame{i:04d}.jpg"
+            Image.fromarray(frame.astype(np.uint8)).save(path, quality=90)
+            detections[path] = vehicle
+        return detections
+
+    return make
@@ -0,0 +1,104 @@
+import os
+import time
+
+import pytest
+import torch
+
+from retrain import checkpoints
+
+
+def make_epochs(num_epochs, seed=0):
+    """Get state dictionaries that drift slightly between epochs, as in retraining."""
+    torch.manual_seed(seed)
+    state_dict = {"weight": torch.randn(64, 32), "num_batches_tracked": torch.tensor(7)}
+    epochs = list()
+    for _ in range(num_epochs):
+        state_dict = {
+            "weight": state_dict["weight"] + 1e-3 * torch.randn(64, 32),
+            "num_batches_tracked": state_dict["num_batches_tracked"] + 1,
+        }
+        epochs.append(state_dict)
+    return epochs
+
+
+def assert_close(loaded, state_dict, tolerance):
+    assert loaded.keys() == state_dict.keys()
+    assert (loaded["weight"] - state_dict["weight"]).abs().max() < tolerance
+    assert loaded["weight"].dtype == torch.float32
+    assert torch.equal(loaded["num_batches_tracked"], state_dict["num_batches_tracked"])
+
+
+def test_fp16_round_trip(tmp_path):
+    state_dict = make_epochs(1)[0]
+    store = checkpoints.CheckpointStore(str(tmp_path), "fp16")
+    path = store.save(state_dict, "init", 1)
+
+    assert torch.load(path)["state_dict"]["weight"].dtype == torch.float16
+    assert_close(checkpoints.load_state_dict(path), state_dict, 1e-2)
+
+
+def test_delta_chain(tmp_path):
+    epochs = make_epochs(7)
+    store = checkpoints.CheckpointStore(str(tmp_path), "delta", keyframe_interval=2)
+    paths = [
+        store.save(epoch_dict, "init", i) for i, epoch_dict in enumerate(epochs, 1)
+    ]
+
+    # Keyframes start a new chain once it holds keyframe_interval deltas
+    ckpts = [torch.load(path) for path in paths]
+    assert [ckpt["chain"] for ckpt in ckpts] == [0, 1, 2, 0, 1, 2, 0]
+    assert ckpts[1]["base"] == os.path.basename(paths[0])
+    assert ckpts[0]["state_dict"]["weight"].dtype == torch.float16
+    assert ckpts[1]["state_dict"]["weight"].dtype == torch.int8
+
+    # Deltas are taken from the decoded base, so they also correct the rounding of the
+    # half precision keyframe
+    checkpoints._decoded.clear()
+    for path, epoch_dict in zip(paths, epochs):
+        assert_close(checkpoints.load_state_dict(path), epoch_dict, 1e-2)
+    for path, epoch_dict in zip(paths[4:6], epochs[4:6]):
+        assert_close(checkpoints.load_state_dict(path), epoch_dict, 1e-4)
+
+    # Checkpoints that are not consecutive are decoded from their keyframe
+    checkpoints._decoded.clear()
+    for i in (5, 2, 6):
+        assert_close(checkpoints.load_state_dict(paths[i]), epochs[i], 1e-2)
+
+
+def test_delta_is_smaller_than_fp16(tmp_path):
+    epochs = make_epochs(4)
+    sizes = dict()
+    for ckpt_format in ("fp16", "delta"):
+        os.mkdir(f"{tmp_path}/{ckpt_format}")
+        store = checkpoints.CheckpointStore(f"{tmp_path}/{ckpt_format}", ckpt_format)
+        paths = [
+            store.save(epoch_dict, "init", i) for i, epoch_dict in enumerate(epochs)
+        ]
+        sizes[ckpt_format] = sum(os.path.getsize(path) for path in paths)
+    assert sizes["delta"] < sizes["fp16"]
+
+
+def test_delta_with_changed_base(tmp_path):
+    epochs = make_epochs(3)
+    store = checkpoints.CheckpointStore(str(tmp_path), "delta")
+    paths = [
+        store.save(epoch_dict, "init", i) for i, epoch_dict in enumerate(epochs, 1)
+    ]
+
+    # Overwriting a base changes its modification time, so it is not read from the cache
+    time.sleep(0.01)
+    torch.save(checkpoints.to_half(make_epochs(1, seed=1)[0]), paths[1])
+    with pytest.raises(RuntimeError, match="has changed"):
+        checkpoints.load_state_dict(paths[2])
+
+    os.remove(paths[1])
+    with pytest.raises(RuntimeError, match="does not exist"):
+        checkpoints.load_state_dict(paths[2])
+
+
+def test_loaded_state_dict_is_a_copy(tmp_path):
+    store = checkpoints.CheckpointStore(str(tmp_path), "fp16")
+    path = store.save(make_epochs(1)[0], "init", 1)
+
+    checkpoints.load_state_dict(path)["weight"] = None
+    assert checkpoints.load_state_dict(path)["weight"] is not None
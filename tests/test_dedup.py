@@ -0,0 +1,37 @@
+import numpy as np
+
+from retrain.dedup import HammingIndex, hamming
+
+
+def flip(code, bits):
+    for bit in bits:
+        code ^= 1 << bit
+    return np.uint64(code)
+
+
+def test_hamming():
+    codes = np.array([0, 1, 2 ** 64 - 1], dtype=np.uint64)
+    assert hamming(np.uint64(0), codes).tolist() == [0, 1, 64]
+
+
+def test_index_finds_codes_within_distance():
+    rand = np.random.default_rng(0)
+    codes = [int(code) for code in rand.integers(0, 2 ** 63, 50, dtype=np.uint64)]
+    index = HammingIndex(3)
+    for i, code in enumerate(codes):
+        index.add(np.uint64(code), i)
+
+    for i, code in enumerate(codes):
+        # Bits spread across the bands, so no band matches exactly for 4 changed bits
+        assert index.query(flip(code, (1, 20, 40, 60))) is None
+        assert index.query(flip(code, (1, 20, 40))) == i
+        assert index.query(np.uint64(code)) == i
+
+
+def test_index_returns_first_match():
+    index = HammingIndex(2)
+    index.add(np.uint64(0b1111), "first")
+    index.add(np.uint64(0b0111), "second")
+
+    assert index.query(np.uint64(0b0011)) == "first"
+    assert HammingIndex(2).query(np.uint64(0)) is None
@@ -0,0 +1,18 @@
+from retrain import gating
+
+
+def test_static_camera_agreement(static_camera):
+    detections = static_camera(40, change_every=8)
+    plan = gating.plan_inference(detections.keys(), 0.03)
+
+    # One frame is inferred per scene, and the other frames reuse its detections
+    assert len(gating.get_inferred(plan)) == 5
+    assert gating.get_agreement(plan, detections) == 1.0
+
+
+def test_unchanged_frames_are_inferred_once(static_camera):
+    detections = static_camera(6, change_every=6)
+    plan = gating.plan_inference(detections.keys(), 0.03)
+
+    assert len(gating.get_inferred(plan)) == 1
+    assert gating.get_agreement(plan, detections) == 1.0
@@ -0,0 +1,59 @@
+import os
+import time
+
+from yolov3.parallelize import JobScheduler
+
+
+def fail_once(marker, how):
+    """Fail the first time it is called with a marker file, and succeed afterwards."""
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        if how == "exit":
+            os._exit(1)
+        raise ValueError("first attempt")
+    return how
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_failed_jobs_are_retried(tmp_path, monkeypatch):
+    # Errors of jobs are also logged to the working directory
+    monkeypatch.chdir(tmp_path)
+    scheduler = JobScheduler(max_workers=2, retries=1, poll_interval=0.2, silent=True)
+    args_list = [(f"{tmp_path}/{how}", how) for how in ("raise", "exit")]
+    results = scheduler.run(fail_once, args_list)
+
+    assert [result.result for result in results] == ["raise", "exit"]
+    assert all(result.ok and result.attempts == 2 for result in results)
+
+
+def test_jobs_fail_after_retries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    scheduler = JobScheduler(max_workers=1, retries=1, poll_interval=0.2, silent=True)
+    result = scheduler.run(fail, [("always",)])[0]
+
+    assert not result.ok
+    assert result.attempts == 2
+    assert "ValueError: always" in result.error
+
+
+def test_timed_out_jobs_are_stopped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # The timeout includes starting the worker, so it leaves time to import PyTorch
+    scheduler = JobScheduler(
+        max_workers=2, retries=0, timeout=10, poll_interval=0.2, silent=True
+    )
+    start = time.time()
+    results = scheduler.run(sleep, [(0,), (120,)])
+
+    assert results[0].ok and results[0].result == 0
+    assert not results[1].ok
+    assert "timed out" in results[1].error
+    assert time.time() - start < 60
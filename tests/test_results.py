@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import analysis.results as rload
+
+
+def make_results(num_rows, seed=0):
+    rand = np.random.default_rng(seed)
+    classes = np.array(["bus", "car", ""])
+    actual = classes[rand.integers(0, 3, num_rows)]
+    detected = np.where(rand.random(num_rows) < 0.8, actual, classes[::-1][:1])
+    return pd.DataFrame(
+        {
+            "file": [f"images/frame{i % 40:04d}.jpg" for i in range(num_rows)],
+            "actual": actual,
+            "detected": detected,
+            "conf": rand.random(num_rows).round(4),
+            "conf_std": (rand.random(num_rows) / 4).round(4),
+            "hit": actual == detected,
+        },
+        columns=rload.COLUMNS,
+    )
+
+
+def test_npz_and_csv_load_the_same(tmp_path):
+    results = make_results(200)
+    results.to_csv(f"{tmp_path}/bench.csv", index=False)
+    rload.write_columns(results, f"{tmp_path}/bench.npz")
+
+    for by_actual in (True, False):
+        from_csv, csv_mat = rload.load_data(f"{tmp_path}/bench.csv", by_actual)
+        from_npz, npz_mat = rload.load_data(f"{tmp_path}/bench.npz", by_actual)
+
+        assert np.array_equal(csv_mat, npz_mat)
+        assert [res.name for res in from_csv] == [res.name for res in from_npz]
+        for csv_res, npz_res in zip(from_csv, from_npz):
+            assert csv_res.get_all() == npz_res.get_all()
+            assert csv_res.counts == npz_res.counts
+            assert len(csv_res) == len(npz_res)
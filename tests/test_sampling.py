@@ -0,0 +1,37 @@
+import random
+
+from retrain.sampling import WeightedReservoir
+
+
+def test_reservoir_keeps_size_items():
+    reservoir = WeightedReservoir(5, random.Random(0))
+    for i in range(100):
+        reservoir.add(i, 1.0)
+
+    assert len(reservoir) == 5
+    items = reservoir.flush()
+    assert len(set(items)) == 5
+    assert len(reservoir) == 0
+
+
+def test_reservoir_skips_zero_weights():
+    reservoir = WeightedReservoir(5, random.Random(0))
+    for i in range(10):
+        reservoir.add(i, 0.0)
+    reservoir.add("weighted", 0.5)
+
+    assert reservoir.flush() == ["weighted"]
+    WeightedReservoir(0, random.Random(0)).add("item", 1.0)
+
+
+def test_reservoir_favors_heavy_items():
+    rand = random.Random(0)
+    heavy = 0
+    for _ in range(200):
+        reservoir = WeightedReservoir(1, rand)
+        reservoir.add("heavy", 9.0)
+        reservoir.add("light", 1.0)
+        heavy += reservoir.flush() == ["heavy"]
+
+    # The heavy item is chosen with probability 0.9
+    assert 160 <= heavy <= 195
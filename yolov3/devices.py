@@ -0,0 +1,132 @@
+"""
+Cached discovery of free GPUs, with reservations for parallel runs.
+
+GPUs are probed at most once per TTL, so model setup can ask for a device as often
+as it likes. Hosts without CUDA or NVIDIA tooling fall back to the CPU.
+"""
+
+import time
+import threading
+
+import torch
+
+try:
+    import gpustat
+except ImportError:
+    gpustat = None
+
+
+class DeviceManager:
+    """Tracks the free memory of each GPU and the memory reserved on it by this process.
+
+    Arguments
+        ttl  seconds before cached GPU statistics are probed again
+    """
+
+    def __init__(self, ttl=10.0):
+        self.ttl = ttl
+        self.reserved = dict()
+        self.pinned = None
+        self._free = None
+        self._probe_time = 0.0
+        self._lock = threading.RLock()
+
+    def probe(self, refresh=False):
+        """Get a dictionary of GPU indices and their free memory in bytes."""
+        with self._lock:
+            expired = time.monotonic() - self._probe_time > self.ttl
+            if self._free is None or expired or refresh:
+                self._free = query_free_memory()
+                self._probe_time = time.monotonic()
+            return dict(self._free)
+
+    def get_free_gpus(self, bytes_needed=0, refresh=False):
+        """Get the GPUs with more than the needed memory free after reservations,
+        sorted by decreasing free memory."""
+        with self._lock:
+            free = {
+                gpu: bytes_free - self.reserved.get(gpu, 0)
+                for gpu, bytes_free in self.probe(refresh).items()
+            }
+        free = {
+            gpu: bytes_free
+            for gpu, bytes_free in free.items()
+            if bytes_free > bytes_needed
+        }
+        return sorted(free.keys(), key=lambda gpu: free[gpu], reverse=True)
+
+    def get_device(self, bytes_needed=0, refresh=False):
+        """Get the GPU with the most free memory, or the CPU if none is available. If a
+        device was pinned, it is always returned instead."""
+        if self.pinned is not None:
+            return self.pinned
+        free_gpus = self.get_free_gpus(bytes_needed, refresh)
+        return torch.device(f"cuda:{free_gpus[0]}" if len(free_gpus) != 0 else "cpu")
+
+    def reserve(self, bytes_needed=0):
+        """Claim memory on the GPU with the most free memory and return its index.
+
+        If no GPU has enough memory left, the GPU with the least memory reserved is
+        shared. Returns None if there are no GPUs.
+        """
+        with self._lock:
+            free_gpus = self.get_free_gpus(bytes_needed)
+            if len(free_gpus) != 0:
+                gpu = free_gpus[0]
+            else:
+                gpus = self.probe().keys()
+                if len(gpus) == 0:
+                    return None
+                gpu = min(gpus, key=lambda gpu: self.reserved.get(gpu, 0))
+            self.reserved[gpu] = self.reserved.get(gpu, 0) + bytes_needed
+            return gpu
+
+    def release(self, gpu, bytes_needed=0):
+        """Return memory claimed with reserve()."""
+        if gpu is None:
+            return
+        with self._lock:
+            self.reserved[gpu] = max(self.reserved.get(gpu, 0) - bytes_needed, 0)
+
+    def pin(self, gpu):
+        """Use a GPU reserved by another process (or the CPU, for None) for every
+        device lookup in this process, since this process does not see its
+        reservations."""
+        self.pinned = get_torch_device(gpu)
+
+    def release_all(self):
+        with self._lock:
+            self.reserved.clear()
+
+
+def get_torch_device(gpu):
+    """Get the PyTorch device of a GPU index, or the CPU for None."""
+    return torch.device(f"cuda:{gpu}" if gpu is not None else "cpu")
+
+
+def query_free_memory():
+    """Query the free memory of each GPU in bytes, returning an empty dictionary if
+    CUDA is unavailable."""
+    if not torch.cuda.is_available():
+        return dict()
+
+    num_gpus = torch.cuda.device_count()
+    if gpustat is not None:
+        try:
+            gpu_stats = gpustat.new_query()
+            return {
+                i: 2 ** 20
+                * (gpu_stats[i]["memory.total"] - gpu_stats[i]["memory.used"])
+                for i in range(num_gpus)
+            }
+        except Exception:
+            pass
+
+    # NVML is unavailable, so ask the CUDA runtime instead
+    try:
+        return {i: torch.cuda.mem_get_info(i)[0] for i in range(num_gpus)}
+    except RuntimeError:
+        return dict()
+
+
+manager = DeviceManager()
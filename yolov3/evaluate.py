@@ -26,9 +26,21 @@ else:
     from torch import FloatTensor
 
 
+def to_model_input(imgs, device):
+    """Move a batch of images to a device, converting uint8 images to floats in [0, 1].
+
+    Loaders transfer uint8 images, which are a quarter of the size, and they are
+    converted once on the batch.
+    """
+    imgs = imgs.to(device)
+    if not imgs.is_floating_point():
+        imgs = imgs.float().div_(255)
+    return imgs
+
+
 def detect(input_imgs, conf_thres, model, nms_thres=0.5):
     # Configure input
-    input_imgs = Variable(input_imgs.type(FloatTensor)).to(model.device)
+    input_imgs = to_model_input(input_imgs, model.device)
 
     with torch.no_grad():
         detections = model(input_imgs)
@@ -55,59 +67,53 @@ def get_most_conf(detections):
     return most_conf
 
 
-def match_detections(img_folder, detections, config):
-    """Match the labels for an image with its bounding boxes"""
-    dataset = img_folder.to_dataset()
-
-    dataloader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=1,
-        shuffle=False,
-        num_workers=1,
-        collate_fn=dataset.collate_fn,
-    )
-
-    device = utils.get_device()
-    boxes = list()
-    for (_, imgs, targets) in dataloader:
-
-        imgs = Variable(imgs.to(device).type(FloatTensor), requires_grad=False)
-
-        # Rescale target
-        targets[:, 2:] = utils.xywh2xyxy(targets[:, 2:])
-        targets[:, 2:] *= img_folder.img_size
-
-        labels = targets[:, 1].tolist()
-
-        # We wish to return a list of pairs (actual label, detection),
-        # where either actual label or detection may be None
-        overlaps = utils.get_batch_statistics(
-            detections, targets, iou_threshold=config["iou_thres"]
-        )[0]
-
-        detections.squeeze_(0)
-        for i in range(len(overlaps[0])):
-            for detection in detections:
-                # Find the boxes that correspond with those generated from
-                # batch statistics
-                if detection[-1] == overlaps[2][i] and detection[4] == overlaps[1][i]:
-                    boxes.append((overlaps[0][i], detection))
-                    break
-        pairs = list()
-
-        # Find true positives
-        for label in labels:
-            correct_box = None
-            for i, (hit, detection) in enumerate(boxes):
-                if hit and detection[-1] == label:
-                    correct_box = detection
-                    del boxes[i]
-                    break
-            pairs.append((label, correct_box))
-
-        # Create false positive results
-        for (hit, detection) in boxes:
-            pairs.append((None, detection))
+def match_detections(targets, detections, config):
+    """Match the labels for an image, as targets from a label index, with its
+    bounding boxes. Returns a list of pairs (actual label, detection), where either
+    actual label or detection may be None."""
+    detections = detections.squeeze(0)
+    labels = targets[:, 1].tolist()
+    target_boxes = utils.xywh2xyxy(targets[:, 2:]) * config["img_size"]
+    num_detections, num_labels = len(detections), len(labels)
+
+    # Assign each detection to its most overlapping label box in order of detections,
+    # as in utils.get_batch_statistics()
+    hits = [False] * num_detections
+    if num_labels != 0 and num_detections != 0:
+        ious = utils.bbox_iou(
+            detections[:, :4].repeat_interleave(num_labels, 0),
+            target_boxes.repeat(num_detections, 1),
+        ).view(num_detections, num_labels)
+        best_ious, best_boxes = ious.max(1)
+
+        detected_boxes = set()
+        for i, (iou, box_i, pred_label) in enumerate(
+            zip(best_ious.tolist(), best_boxes.tolist(), detections[:, -1].tolist())
+        ):
+            if len(detected_boxes) == num_labels:
+                break
+            if pred_label not in labels:
+                continue
+            if iou >= config["iou_thres"] and box_i not in detected_boxes:
+                hits[i] = True
+                detected_boxes.add(box_i)
+
+    boxes = list(zip(hits, detections))
+    pairs = list()
+
+    # Find true positives
+    for label in labels:
+        correct_box = None
+        for i, (hit, detection) in enumerate(boxes):
+            if hit and detection[-1] == label:
+                correct_box = detection
+                del boxes[i]
+                break
+        pairs.append((label, correct_box))
+
+    # Create false positive results
+    for (hit, detection) in boxes:
+        pairs.append((None, detection))
 
     return pairs
 
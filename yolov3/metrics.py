@@ -0,0 +1,93 @@
+"""
+Training metrics of YOLO layers, accumulated on the model's device between logs.
+
+Reading a metric from the GPU waits for all queued work to finish, so metrics are summed
+as tensors after each batch and only copied to the CPU when they are logged.
+"""
+
+import torch
+
+from terminaltables import AsciiTable
+
+FORMATS = {"grid_size": "%2d", "cls_acc": "%.2f%%"}
+
+
+class MetricsTracker:
+    """Averages the metrics of each YOLO layer over the batches between logs.
+
+    Metrics that are undefined for a batch (NaN), such as the confidence of objects in a
+    batch without any, are left out of their average.
+
+    Arguments
+        model    Darknet model being trained
+        metrics  names of the metrics to track, which may include grid_size
+    """
+
+    def __init__(self, model, metrics):
+        self.model = model
+        self.metrics = [metric for metric in metrics if metric != "grid_size"]
+        self.show_grid_size = "grid_size" in metrics
+        self.reset()
+
+    def reset(self):
+        self.sums = None
+        self.counts = None
+        self.loss = None
+        self.batches = 0
+
+    def update(self, loss):
+        """Add the metrics of the last forward pass, without synchronizing."""
+        values = torch.stack(
+            [
+                torch.stack([yolo.metrics[metric] for metric in self.metrics])
+                for yolo in self.model.yolo_layers
+            ]
+        ).float()
+        defined = ~torch.isnan(values)
+        values = torch.where(defined, values, torch.zeros_like(values))
+
+        if self.sums is None:
+            self.sums, self.counts, self.loss = values, defined.float(), loss.detach()
+        else:
+            self.sums += values
+            self.counts += defined
+            self.loss += loss.detach()
+        self.batches += 1
+
+    def summarize(self):
+        """Get the average loss and a list of dictionaries with the average metrics of
+        each YOLO layer, then start a new average."""
+        if self.batches == 0:
+            return None, list()
+
+        averages = (self.sums / self.counts).tolist()
+        loss = self.loss.item() / self.batches
+        layers = list()
+        for yolo, layer_averages in zip(self.model.yolo_layers, averages):
+            layer = dict(zip(self.metrics, layer_averages))
+            if self.show_grid_size:
+                layer["grid_size"] = yolo.metrics["grid_size"]
+            layers.append(layer)
+
+        self.reset()
+        return loss, layers
+
+
+def get_scalars(loss, layers):
+    """Get TensorBoard tag-value pairs of summarized metrics."""
+    scalars = [
+        (f"{name}_{j + 1}", value)
+        for j, layer in enumerate(layers)
+        for name, value in layer.items()
+        if name != "grid_size"
+    ]
+    return scalars + [("loss", loss)]
+
+
+def format_table(layers, metrics):
+    """Render summarized metrics as a table with a column for each YOLO layer."""
+    table = [["Metrics", *[f"YOLO Layer {i}" for i in range(len(layers))]]]
+    for metric in metrics:
+        row_format = FORMATS.get(metric, "%.6f")
+        table.append([metric, *[row_format % layer.get(metric, 0) for layer in layers]])
+    return AsciiTable(table).table
@@ -4,7 +4,7 @@ import torch
 import torch.nn as nn
 import numpy as np
 
-from yolov3 import utils
+from yolov3 import utils, shared, devices
 
 if torch.cuda.is_available():
     from torch.cuda import FloatTensor
@@ -251,20 +251,22 @@ class YOLOLayer(nn.Module):
             recall50 = torch.sum(iou50 * detected_mask) / (obj_mask.sum() + 1e-16)
             recall75 = torch.sum(iou75 * detected_mask) / (obj_mask.sum() + 1e-16)
 
+            # Metrics stay on the device until they are logged, to avoid a sync
+            # after every batch
             self.metrics = {
-                "loss": utils.to_cpu(total_loss).item(),
-                "x": utils.to_cpu(loss_x).item(),
-                "y": utils.to_cpu(loss_y).item(),
-                "w": utils.to_cpu(loss_w).item(),
-                "h": utils.to_cpu(loss_h).item(),
-                "conf": utils.to_cpu(loss_conf).item(),
-                "cls": utils.to_cpu(loss_cls).item(),
-                "cls_acc": utils.to_cpu(cls_acc).item(),
-                "recall50": utils.to_cpu(recall50).item(),
-                "recall75": utils.to_cpu(recall75).item(),
-                "precision": utils.to_cpu(precision).item(),
-                "conf_obj": utils.to_cpu(conf_obj).item(),
-                "conf_noobj": utils.to_cpu(conf_noobj).item(),
+                "loss": total_loss.detach(),
+                "x": loss_x.detach(),
+                "y": loss_y.detach(),
+                "w": loss_w.detach(),
+                "h": loss_h.detach(),
+                "conf": loss_conf.detach(),
+                "cls": loss_cls.detach(),
+                "cls_acc": cls_acc.detach(),
+                "recall50": recall50.detach(),
+                "recall75": recall75.detach(),
+                "precision": precision.detach(),
+                "conf_obj": conf_obj.detach(),
+                "conf_noobj": conf_noobj.detach(),
                 "grid_size": grid_size,
             }
 
@@ -422,33 +424,33 @@ class Darknet(nn.Module):
         fp.close()
 
 
-def get_eval_model(model_def, img_size, weights_path=None):
-    device = utils.get_device()
+def get_eval_model(model_def, img_size, weights_path=None, device=None):
+    """Get a Darknet model in evaluation mode on a reserved GPU index (or the CPU, for
+    None), or on the device with the most free memory if no device is given."""
+    device = utils.get_device() if device is None else devices.get_torch_device(device)
 
     # Set up model
     model = Darknet(model_def, img_size=img_size).to(device)
     model.device = device
     if weights_path is not None:
-        model.load_state_dict(torch.load(weights_path, map_location=device))
+        model.load_state_dict(shared.load_state_dict(weights_path, map_location=device))
     model.eval()  # Set in evaluation mode
 
     return model
 
 
 def get_train_model(config, device=None):
+    """Get a Darknet model for training on a reserved GPU index, or on the GPU with
+    enough free memory for training if no device is given."""
     model_def = utils.parse_model_config(config["model_config"])
     model = Darknet(model_def, config["img_size"])
 
-    # Rough estimate of model size, in bytes
-    memory_needed = utils.get_memory_needed(config)
-    free_gpus = utils.get_free_gpus(memory_needed)
-
-    if device is None or device not in free_gpus:
-        device_str = f"cuda:{free_gpus[0]}" if len(free_gpus) != 0 else "cpu"
+    if device is None:
+        # Rough estimate of model size, in bytes
+        memory_needed = utils.get_memory_needed(config)
+        device = devices.manager.get_device(memory_needed)
     else:
-        device_str = f"cuda:{device}"
-
-    device = torch.device(device_str)
+        device = devices.get_torch_device(device)
     model.device = device
 
     return model.to(device)
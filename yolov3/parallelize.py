@@ -5,33 +5,308 @@ production on Sage nodes.
 """
 
 import os
+import time
 import traceback
+from collections import deque
 
 import multiprocessing as mp
-from multiprocessing.pool import Pool
+from multiprocessing.connection import wait
 
-from yolov3 import utils
+from yolov3 import devices
 
 
-def run_parallel(func, args_list, init=True):
-    """Run a function multiple times in parallel, with a pool size determined
-    by the number of free GPUs.
+def run_parallel(
+    func,
+    args_list,
+    init=True,
+    memory_needed=0,
+    pass_device=False,
+    retries=1,
+    timeout=None,
+):
+    """Run a function multiple times in parallel with a JobScheduler, returning
+    a JobResult for each set of arguments, in order.
 
     Arguments
-        func       function to call
-        args_list  list containing a tuple (or other iterable) of arguments
-        init       specify if this is the first time running paralllel code within the process
+        func           function to call
+        args_list      list containing a tuple (or other iterable) of arguments
+        init           specify if this is the first time running paralllel code within the process
+        memory_needed  estimated memory for each call, in bytes
+        pass_device    pass the GPU index (or None for the CPU) of the worker's device
+                       slot as the device keyword argument
+        retries        number of times to rerun a call that failed
+        timeout        seconds after which a call is stopped and failed, or None
     """
     if init:
+        os.environ["MKL_THREADING_LAYER"] = "GNU"
+
+    scheduler = JobScheduler(
+        memory_needed=memory_needed, retries=retries, timeout=timeout
+    )
+    results = scheduler.run(func, args_list, pass_device)
+
+    for result in results:
+        if not result.ok:
+            print(f"Job with arguments {result.args} failed:\n{result.error}")
+    return results
+
+
+class JobResult:
+    """Outcome of a job, holding either its return value or the error of its last
+    failed attempt."""
+
+    def __init__(self, args):
+        self.args = args
+        self.result = None
+        self.error = None
+        self.attempts = 0
+        self.device = None
+        self.time = 0.0
+
+    @property
+    def ok(self):
+        return self.attempts != 0 and self.error is None
+
+
+class JobScheduler:
+    """Runs jobs in a fixed set of worker processes, sending the next job to each
+    worker whenever it becomes idle.
+
+    The number of workers is bounded by the number of CPU cores, the available host
+    memory and the number of jobs that fit in GPU memory. Each worker holds a device
+    slot reserved from the device manager, or the CPU if there are no GPUs.
+
+    Arguments
+        max_workers    upper bound on the number of workers, defaults to the number of cores
+        memory_needed  estimated memory for each job, in bytes
+        retries        number of times to rerun a job that raised an exception, whose
+                       worker died or that timed out
+        timeout        seconds after which a job is stopped and failed, or None
+        poll_interval  seconds between checks for dead or timed out workers
+        silent         do not print progress
+    """
+
+    def __init__(
+        self,
+        max_workers=None,
+        memory_needed=0,
+        retries=1,
+        timeout=None,
+        poll_interval=1.0,
+        silent=False,
+    ):
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.memory_needed = memory_needed
+        self.retries = retries
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.silent = silent
+        self.context = mp.get_context("spawn")
+
+    def get_num_workers(self, num_jobs):
+        num_workers = min(num_jobs, self.max_workers)
+
+        if self.memory_needed > 0:
+            host_memory = get_available_memory()
+            if host_memory is not None:
+                num_workers = min(num_workers, host_memory // self.memory_needed)
+
+            gpu_memory = devices.manager.probe()
+            if len(gpu_memory) != 0:
+                gpu_slots = sum(
+                    free // self.memory_needed for free in gpu_memory.values()
+                )
+                num_workers = min(num_workers, gpu_slots)
+
+        return max(int(num_workers), 1)
+
+    def run(self, func, args_list, pass_device=False):
+        """Run func(*args) for each set of arguments and return a list of JobResults
+        in the same order."""
+        results = [JobResult(tuple(args)) for args in args_list]
+        if len(results) == 0:
+            return results
+
+        self.func, self.pass_device = func, pass_device
+        self.pending = deque(range(len(results)))
+
+        num_workers = self.get_num_workers(len(results))
+        slots = [
+            devices.manager.reserve(self.memory_needed) for _ in range(num_workers)
+        ]
+        workers = [self.start_worker(i, slot) for i, slot in enumerate(slots)]
+        # Jobs are dispatched to a worker's own queue and events come back through its
+        # own pipe, so the job of a worker that dies is known even if the worker never
+        # reported starting it, and a dying worker cannot block the others' events
+        self.running = [None] * num_workers
+        remaining = len(results)
+
+        self.log(f"Running {remaining} jobs on {num_workers} workers")
+        try:
+            for i, worker in enumerate(workers):
+                self.dispatch(i, worker, results)
+
+            last_check = time.time()
+            while remaining > 0:
+                events = [worker.events for worker in workers]
+                for conn in wait(events, timeout=self.poll_interval):
+                    try:
+                        event = conn.recv()
+                    except (EOFError, OSError):
+                        # The worker exited, so it is replaced right away
+                        last_check = 0.0
+                        continue
+                    remaining -= self.handle(event, results, slots)
+
+                if time.time() - last_check >= self.poll_interval:
+                    # Fail the job of any worker that died or ran out of time, and
+                    # replace the worker
+                    for i, worker in enumerate(workers):
+                        error = self.check_worker(worker, self.running[i])
+                        if error is None:
+                            continue
+                        if self.running[i] is not None:
+                            job_id, start = self.running[i]
+                            event = ("error", i, job_id, error, time.time() - start)
+                            self.running[i] = None
+                            remaining -= self.finish(event, results)
+                        worker.join()
+                        worker.events.close()
+                        workers[i] = self.start_worker(i, slots[i])
+                    last_check = time.time()
+
+                for i, worker in enumerate(workers):
+                    self.dispatch(i, worker, results)
+        except BaseException:
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.job_queue.put(None)
+            for worker in workers:
+                worker.join(timeout=self.poll_interval * 10)
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+                worker.events.close()
+            for slot in slots:
+                devices.manager.release(slot, self.memory_needed)
+
+        return results
+
+    def handle(self, event, results, slots):
+        """Handle an event sent by a worker. Returns 1 if a job is done, or 0."""
+        status, worker_i, job_id = event[:3]
+        running = self.running[worker_i]
+        if running is None or running[0] != job_id:
+            # The job was already failed after its worker was replaced
+            return 0
+
+        if status == "start":
+            slot = slots[worker_i]
+            device = f"GPU {slot}" if slot is not None else "CPU"
+            self.log(f"Started job {job_id + 1}/{len(results)} on {device}")
+            return 0
+
+        self.running[worker_i] = None
+        return self.finish(event, results)
+
+    def start_worker(self, worker_i, slot):
+        job_queue = self.context.Queue()
+        events, worker_events = self.context.Pipe(duplex=False)
+        worker = self.context.Process(
+            target=run_worker,
+            args=(worker_i, slot, job_queue, worker_events),
+            daemon=False,
+        )
+        worker.start()
+        # Only the worker writes to the pipe, so it reads as closed once the worker exits
+        worker_events.close()
+        worker.job_queue, worker.events, worker.slot = job_queue, events, slot
+        return worker
+
+    def dispatch(self, worker_i, worker, results):
+        """Send the next pending job to a worker if it is idle."""
+        if self.running[worker_i] is not None or len(self.pending) == 0:
+            return
+        job_id = self.pending.popleft()
+        results[job_id].device = worker.slot
+        self.running[worker_i] = (job_id, time.time())
+        worker.job_queue.put(
+            (job_id, self.func, results[job_id].args, self.pass_device)
+        )
+
+    def check_worker(self, worker, running):
+        """Get the reason a worker must be replaced, or None if it is healthy."""
+        if not worker.is_alive():
+            return f"Worker exited with code {worker.exitcode}"
+        if (
+            running is not None
+            and self.timeout is not None
+            and time.time() - running[1] > self.timeout
+        ):
+            worker.terminate()
+            worker.join()
+            return f"Job timed out after {self.timeout}s"
+        return None
+
+    def finish(self, event, results):
+        """Record a finished attempt, requeueing a failed job if it has retries left.
+        Returns 1 if the job is done, or 0 if it was requeued."""
+        status, _, job_id, value, elapsed = event
+        result = results[job_id]
+        result.attempts += 1
+        result.time += elapsed
+
+        if status == "done":
+            result.result, result.error = value, None
+            self.log(f"Finished job {job_id + 1}/{len(results)} in {elapsed:.1f}s")
+            return 1
+
+        result.error = value
+        if result.attempts <= self.retries:
+            self.log(f"Job {job_id + 1}/{len(results)} failed, retrying")
+            self.pending.append(job_id)
+            return 0
+
+        self.log(f"Job {job_id + 1}/{len(results)} failed")
+        return 1
+
+    def log(self, message):
+        if not self.silent:
+            print(message)
+
+
+def run_worker(worker_i, slot, job_queue, events):
+    """Run jobs from the queue until a None job is received."""
+    # Reservations are made by the scheduler, so the worker uses its slot instead of
+    # probing for a free GPU itself
+    devices.manager.pin(slot)
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, func, args, pass_device = job
+        events.send(("start", worker_i, job_id))
+
+        start = time.time()
+        kwargs = {"device": slot} if pass_device else dict()
         try:
-            os.environ["MKL_THREADING_LAYER"] = "GNU"
-            mp.set_start_method("spawn")
-        except RuntimeError:
-            pass
-    with NoDaemonPool(len(utils.get_free_gpus()) * 10) as pool:
-        pool.starmap_async(func, args_list)
-        pool.close()
-        pool.join()
+            result = ExceptionLogger(func)(*args, **kwargs)
+            event = ("done", worker_i, job_id, result, time.time() - start)
+        except Exception as e:
+            event = ("error", worker_i, job_id, str(e), time.time() - start)
+        events.send(event)
+
+
+def get_available_memory():
+    """Get the available host memory in bytes, or None if it cannot be determined."""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
 
 
 class ExceptionLogger:
@@ -49,26 +324,3 @@ class ExceptionLogger:
                 out.write(traceback.format_exc())
             raise Exception(traceback.format_exc())
         return result
-
-
-class NoDaemonProcess(mp.Process):
-    """Class to override multithreading errors when calling daemon processes."""
-
-    def _get_daemon(self):
-        return False
-
-    def _set_daemon(self, value):
-        pass
-
-    daemon = property(_get_daemon, _set_daemon)
-
-
-class NoDaemonPool(Pool):
-    """Class to override multithreading errors when pooling daemon processes."""
-
-    Process = NoDaemonProcess
-
-    def starmap_async(self, func, iterable, *args, **kwargs):
-        return Pool.starmap_async(
-            self, ExceptionLogger(func), iterable, *args, **kwargs
-        )
@@ -0,0 +1,73 @@
+"""
+Checkpoints and labels loaded once by a parent process and shared with its workers.
+
+Tensors are moved to shared memory, so sending a SharedState to a worker process only
+sends handles to the same memory. A worker calls attach() once, after which
+load_state_dict() and the label index of LabeledSets read from the shared copies
+instead of loading their own from disk.
+"""
+
+import os
+
+from retrain import checkpoints
+
+attached = None
+
+
+class SharedState:
+    """State dictionaries of checkpoints and a label index held in shared memory."""
+
+    def __init__(self):
+        self.state_dicts = dict()
+        self.label_index = dict()
+        self.labeled = set()
+
+    def add_checkpoint(self, path):
+        """Load a checkpoint onto the CPU and move its tensors to shared memory."""
+        key = os.path.realpath(path)
+        if key not in self.state_dicts.keys() and os.path.exists(path):
+            state_dict = checkpoints.load_state_dict(path, map_location="cpu")
+            for tensor in state_dict.values():
+                tensor.share_memory_()
+            self.state_dicts[key] = state_dict
+
+    def add_labels(self, labeled_set, labeled_imgs=None):
+        """Add the label index of a LabeledSet, moving its targets to shared memory.
+
+        Images that were labeled, including those left without labels, may be given
+        so that workers do not label them again.
+        """
+        for img, targets in labeled_set.get_label_index().items():
+            self.label_index[img] = targets.share_memory_()
+        self.labeled.update(labeled_set.imgs if labeled_imgs is None else labeled_imgs)
+
+    def attach(self):
+        """Use this state for loading checkpoints and labels in the current process."""
+        global attached
+        attached = self
+
+
+def load_state_dict(path, map_location=None):
+    """Load the state dictionary of a checkpoint, using the attached shared state if it
+    holds the checkpoint.
+
+    Shared tensors stay on the CPU, and Module.load_state_dict() copies them to the
+    model's device.
+    """
+    if attached is not None:
+        state_dict = attached.state_dicts.get(os.path.realpath(path))
+        if state_dict is not None:
+            return state_dict
+    return checkpoints.load_state_dict(path, map_location=map_location)
+
+
+def is_labeled(img):
+    """Check if an image was labeled by the process that created the attached state."""
+    return attached is not None and img in attached.labeled
+
+
+def get_labels(img):
+    """Get the targets of an image from the attached shared state, or None."""
+    if attached is None:
+        return None
+    return attached.label_index.get(img)
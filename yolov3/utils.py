@@ -3,9 +3,8 @@ import torch
 from torch import cuda, nn
 
 import numpy as np
-import gpustat
-
 from retrain import utils
+from yolov3 import devices
 
 if cuda.is_available():
     from torch.cuda import FloatTensor, BoolTensor
@@ -333,14 +332,19 @@ def rescale_boxes(boxes, current_dim, original_shape):
     return boxes
 
 
-def pad_to_square(img, pad_value):
-    """Pad an image to a square."""
-    _, h, w = img.shape
+def get_padding(h, w):
+    """Get the (left, right, top, bottom) padding needed to make an image square."""
     dim_diff = np.abs(h - w)
     # (upper / left) padding and (lower / right) padding
     pad1, pad2 = dim_diff // 2, dim_diff - dim_diff // 2
     # Determine padding
-    pad = (0, 0, pad1, pad2) if h <= w else (pad1, pad2, 0, 0)
+    return (0, 0, pad1, pad2) if h <= w else (pad1, pad2, 0, 0)
+
+
+def pad_to_square(img, pad_value):
+    """Pad an image to a square."""
+    _, h, w = img.shape
+    pad = get_padding(h, w)
     # Add padding
     img = nn.functional.pad(img, pad, "constant", value=pad_value)
 
@@ -417,28 +421,16 @@ def to_cpu(tensor):
     return tensor.detach().cpu()
 
 
-def get_device():
-    free_gpus = get_free_gpus()
-    device_str = f"cuda:{free_gpus[0]}" if len(free_gpus) != 0 else "cpu"
-    device = torch.device(device_str)
-    return device
+def get_device(refresh=False):
+    return devices.manager.get_device(refresh=refresh)
 
 
 def get_memory_needed(config):
     return config["img_size"] ** 2 * config["batch_size"] * 3 * 4 * 160
 
 
-def get_free_gpus(bytes_needed=0):
-    free_gpus = dict()
-    gpu_stats = gpustat.new_query()
-    for i in range(cuda.device_count()):
-        bytes_free = 2 ** 20 * (
-            gpu_stats[i]["memory.total"] - gpu_stats[i]["memory.used"]
-        )
-        if bytes_free > bytes_needed:
-            free_gpus[i] = bytes_free
-    free_gpus = dict(sorted(free_gpus.items(), key=lambda gpu: gpu[1], reverse=True))
-    return list(free_gpus.keys())
+def get_free_gpus(bytes_needed=0, refresh=False):
+    return devices.manager.get_free_gpus(bytes_needed, refresh)
 
 
 def clear_vram():